@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import json
+import sys
+import numpy as np
+from typing import Any, Dict, List, Optional
+from utils.profiling import track_timings
+from .evalvec import csv_list
+from .loadtest import add_app_arguments, load_replay, percentiles, pin_environment, setup_app
+
+# Candidate depth sweep: adaptive depth (select_depth) against fixed depths, on the real final_eval path
+# with bench/stubs.py stand-ins.
+#
+#   python -m bench.depthsweep --fixed 2,4,6 --baseline 4
+#
+# The rerank stub orders candidates by a noisy relevance judge over the synthetic corpus, and its latency grows
+# per candidate (--rerank ...:per_item_ms), so both sides of the trade-off show up:
+# - latency: rerank and total time, candidates per prompt
+# - ranking: top-count agreement with the fixed baseline (overlap, identical lists),
+#   and overlap with the judge's own top-count over the whole corpus (what an unlimited rerank would return)
+# Caches are off, so every query runs the full pipeline for every variant.
+
+async def run_variant(search, stubs, bodies: List[Dict[str, Any]], mult: Optional[float], concurrency: int) -> Dict[str, Any]:
+    """
+    final_eval for every replay body, with k = mult x count, or adaptive depth if mult is None.
+    """
+    gate = asyncio.Semaphore(concurrency)
+    results: Dict[str, List[int]] = {}
+    timings: Dict[str, Dict[str, float]] = {}
+    degraded = 0
+
+    async def one(body: Dict[str, Any]) -> None:
+        nonlocal degraded
+        count = body["count"]
+        k = int(np.ceil(mult * count)) if mult is not None else None
+        async with gate:
+            with track_timings() as stages:
+                ranked = await search.final_eval(user_input=body["text"], k=k, final_cnt=count)
+        results[body["text"]] = [ret.image_id for ret in ranked.text]
+        timings[body["text"]] = {name: seconds * 1e3 for name, seconds in stages}
+        degraded += bool(ranked.degraded)
+
+    search.result_cache.invalidate()
+    await asyncio.gather(*(one(body) for body in bodies))
+
+    return {
+        "variant": "adaptive" if mult is None else f"fixed {mult:g}x",
+        "mult": mult,
+        "results": results,
+        "candidates": [stubs.prompt_sizes.get(body["text"].strip(), 0) for body in bodies],
+        "rerank_ms": [timings[body["text"]].get("rerank", 0.0) for body in bodies],
+        "total_ms": [timings[body["text"]]["total"] for body in bodies],
+        "degraded": degraded,
+    }
+
+def overlap(found: List[int], expected: List[int], count: int) -> float:
+    return len(set(found[:count]) & set(expected[:count])) / max(1, min(count, len(expected)))
+
+def summarize(variant: Dict[str, Any], baseline: Dict[str, Any], oracle: Dict[str, List[int]], bodies: List[Dict[str, Any]]) -> Dict[str, Any]:
+
+    agreement, identical, quality = [], [], []
+    for body in bodies:
+        text, count = body["text"], body["count"]
+        found, expected = variant["results"][text], baseline["results"][text]
+        agreement.append(overlap(found, expected, count))
+        identical.append(found[:count] == expected[:count])
+        quality.append(overlap(found, oracle[text], count))
+
+    return {
+        "variant": variant["variant"],
+        "candidates_mean": float(np.mean(variant["candidates"])),
+        "rerank_ms": percentiles(variant["rerank_ms"]),
+        "total_ms": percentiles(variant["total_ms"]),
+        "agreement": float(np.mean(agreement)),
+        "identical": float(np.mean(identical)),
+        "oracle_overlap": float(np.mean(quality)),
+        "degraded": variant["degraded"],
+    }
+
+def format_report(rows: List[Dict[str, Any]], baseline: str) -> str:
+
+    lines = [
+        f"| variant | candidates | rerank p50 ms | rerank p95 ms | total p50 ms | total p95 ms | overlap vs {baseline} | identical | overlap vs judge | degraded |",
+        "|---|---:|---:|---:|---:|---:|---:|---:|---:|---:|",
+    ]
+    for r in rows:
+        lines.append(
+            f"| {r['variant']} | {r['candidates_mean']:.1f} | {r['rerank_ms']['p50']:.0f} | {r['rerank_ms']['p95']:.0f} "
+            f"| {r['total_ms']['p50']:.0f} | {r['total_ms']['p95']:.0f} | {r['agreement']:.3f} | {r['identical']:.3f} "
+            f"| {r['oracle_overlap']:.3f} | {r['degraded']} |"
+        )
+
+    return "\n".join(lines)
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+
+    main, search, stubs = setup_app(args)
+
+    # One request per distinct query: repeats would be merged by single-flight
+    bodies = list({body["text"]: body for body in load_replay(args.replay, args.count)}.values())
+    oracle = {}
+    for body in bodies:
+        relevance = stubs.corpus.judge(body["text"])
+        oracle[body["text"]] = stubs.corpus.ids[np.argsort(-relevance)[:body["count"]]].tolist()
+
+    mults = [None] + [mult for mult in args.fixed if mult != args.baseline] + [args.baseline]
+    variants = {}
+    async with main.app.router.lifespan_context(main.app):
+        for mult in mults:
+            variant = await run_variant(search, stubs, bodies, mult, args.concurrency)
+            variants[mult] = variant
+            print(f"{variant['variant']}: {np.mean(variant['candidates']):.1f} candidates", file=sys.stderr)
+
+    baseline = variants[args.baseline]
+    rows = [summarize(variants[mult], baseline, oracle, bodies) for mult in mults]
+    # Adaptive first, then fixed depths from shallow to deep
+    return rows[:1] + sorted(rows[1:], key=lambda row: float(row["variant"].split()[1].rstrip("x")))
+
+def cli() -> None:
+
+    parser = argparse.ArgumentParser(description="Adaptive vs fixed rerank candidate depth: latency and top-count agreement.")
+    add_app_arguments(parser, rerank="400:0.2:0:15")
+    parser.add_argument("--fixed", default="2,4,6", type=csv_list(float), help="fixed depths as multiples of count")
+    parser.add_argument("--baseline", default=4.0, type=float, help="fixed multiple the others are compared with")
+    parser.add_argument("--concurrency", default=8, type=int, help="queries in flight at once")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Every variant must run the full pipeline, and rerank failures would mix local ranking into the comparison
+    pin_environment(args, no_cache=True)
+    rows = asyncio.run(run(args))
+    print(format_report(rows, f"fixed {args.baseline:g}x"))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    cli()
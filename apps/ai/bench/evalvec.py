@@ -0,0 +1,198 @@
+import argparse
+import json
+import time
+import numpy as np
+from loguru import logger
+from typing import Any, Dict, List, Optional, Tuple
+from utils.indexfile import open_index_file
+from utils.ivf import IVFIndex
+from utils.vindex import LocalVectorIndex
+
+# Recall/latency evaluation of the in-process vector engines against exact search.
+#
+#   python -m bench.evalvec index/vectors.json --k 10 --json eval.json --markdown eval.md
+#
+# The corpus is an export of [{"image_id", "vector"}] (embedder.py's VECTOR_INDEX_PATH, prep.py's embeddings.json)
+# or a mapped .idx index file. Queries come from --queries (same record shape, or bare vectors);
+# without it, perturbed copies of stored vectors are used. Every engine/parameter setting is scored
+# on recall@k and MRR against exact float32 ground truth, and timed one query at a time, as the server runs them.
+
+def load_corpus(corpus_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (ids, vectors) from a JSON export or an index file.
+    """
+    if corpus_path.endswith(".idx"):
+        index, _ = open_index_file(corpus_path)
+        return np.array(index.ids), np.array(index.matrix)
+
+    with open(corpus_path, "r", encoding="utf-8") as f:
+        records = [record for record in json.load(f) if record.get("vector") is not None]
+
+    ids = np.array([record["image_id"] for record in records], dtype=np.int64)
+    vectors = np.array([record["vector"] for record in records], dtype=np.float32)
+    return ids, vectors
+
+def load_queries(queries_path: Optional[str], corpus: np.ndarray, count: int, noise: float, seed: int = 0) -> np.ndarray:
+    """
+    Unit query vectors: from a file of records ({"vector"}) or bare vectors, or perturbed copies of
+    `count` random corpus rows (noise is the perturbation norm relative to the unit vectors).
+    """
+    if queries_path:
+        with open(queries_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        queries = np.array([item["vector"] if isinstance(item, dict) else item for item in data], dtype=np.float32)
+    else:
+        rng = np.random.default_rng(seed)
+        sample = corpus[rng.choice(corpus.shape[0], size=min(count, corpus.shape[0]), replace=False)]
+        queries = sample + rng.normal(scale=noise / np.sqrt(corpus.shape[1]), size=sample.shape).astype(np.float32)
+
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return queries / norms
+
+def score(results: List[List[int]], truth: List[List[int]], k: int) -> Tuple[float, float]:
+    """
+    recall@k (overlap with the exact top-k) and MRR (reciprocal rank of the exact nearest neighbour, 0 if missed).
+    """
+    recall, mrr = [], []
+    for found, expected in zip(results, truth):
+        recall.append(len(set(found[:k]) & set(expected[:k])) / max(1, min(k, len(expected))))
+        rank = found.index(expected[0]) + 1 if expected and expected[0] in found else None
+        mrr.append(1.0 / rank if rank else 0.0)
+
+    return float(np.mean(recall)), float(np.mean(mrr))
+
+def time_queries(search, queries: np.ndarray) -> Tuple[List[List[int]], np.ndarray]:
+    """
+    Runs `search` on each query; returns the hit ids and per-query latencies in ms.
+    """
+    results, latencies = [], np.empty(len(queries))
+    for i, q in enumerate(queries):
+        started = time.perf_counter()
+        hits = search(q)
+        latencies[i] = (time.perf_counter() - started) * 1e3
+        results.append([hit.image_id for hit in hits])
+
+    return results, latencies
+
+def evaluate(
+    ids: np.ndarray, vectors: np.ndarray, queries: np.ndarray, k: int,
+    precisions: List[str], rescore_mults: List[int], coarse_dims: List[int], nprobes: List[int], nlist: Optional[int]
+) -> List[Dict[str, Any]]:
+
+    exact = LocalVectorIndex(ids, vectors)
+    truth = [[hit.image_id for hit in hits] for hits in exact.search_batch(queries, k)]
+
+    # (engine, params, index, nprobe); every IVF setting shares one clustering of the exact index
+    settings: List[Tuple[str, Dict[str, Any], LocalVectorIndex, Optional[int]]] = [("exact", {"precision": "float32"}, exact, None)]
+    for precision in precisions:
+        if precision == "float32":
+            continue
+        for mult in rescore_mults:
+            index = LocalVectorIndex(ids, vectors, precision=precision, rescore_mult=mult)
+            settings.append(("quantized", {"precision": precision, "rescore_mult": mult}, index, None))
+    for coarse_dim in coarse_dims:
+        if coarse_dim >= exact.dim:
+            continue
+        for precision in precisions:
+            for mult in rescore_mults:
+                index = LocalVectorIndex(ids, vectors, precision=precision, rescore_mult=mult, coarse_dim=coarse_dim)
+                settings.append(("matryoshka", {"precision": precision, "coarse_dim": coarse_dim, "rescore_mult": mult}, index, None))
+
+    ivf = None
+    build_s = 0.0
+    if nprobes:
+        started = time.perf_counter()
+        ivf = IVFIndex.build(exact, nlist=nlist)
+        build_s = time.perf_counter() - started
+        for nprobe in nprobes:
+            if nprobe <= ivf.nlist:
+                settings.append(("ivf", {"precision": "float32", "nlist": ivf.nlist, "nprobe": nprobe}, exact, nprobe))
+
+    report = []
+    for engine, params, index, nprobe in settings:
+        if engine == "ivf":
+            search = lambda q, nprobe=nprobe: ivf.search(q, k, nprobe=nprobe)
+        else:
+            search = lambda q, index=index: index.search(q, k)
+
+        search(queries[0]) # warm-up
+        results, latencies = time_queries(search, queries)
+        recall, mrr = score(results, truth, k)
+
+        # IVF reads the centroids plus about nprobe / nlist of the rows
+        scanned = index.nbytes if engine != "ivf" else index.nbytes * min(1.0, nprobe / ivf.nlist) + ivf.centroids.nbytes
+        row = {
+            "engine": engine,
+            "params": params,
+            "mib_scanned": scanned / 2**20,
+            "recall": recall,
+            "mrr": mrr,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "mean_ms": float(latencies.mean()),
+        }
+        if engine == "ivf":
+            row["build_s"] = build_s
+        report.append(row)
+        logger.info(f"{engine} {params}: recall@{k} {recall:.4f}, MRR {mrr:.4f}, p50 {row['p50_ms']:.2f} ms")
+
+    return report
+
+def format_markdown(report: List[Dict[str, Any]], meta: Dict[str, Any]) -> str:
+
+    k = meta["k"]
+    lines = [
+        f"Corpus {meta['corpus']} ({meta['n']} x {meta['dim']}), {meta['queries']} queries, k={k}",
+        "",
+        f"| engine | params | MiB scanned | recall@{k} | MRR | p50 ms | p95 ms |",
+        "|---|---|---:|---:|---:|---:|---:|",
+    ]
+    for row in report:
+        params = ", ".join(f"{key}={value}" for key, value in row["params"].items())
+        lines.append(
+            f"| {row['engine']} | {params} | {row['mib_scanned']:.2f} | {row['recall']:.4f} | {row['mrr']:.4f} "
+            f"| {row['p50_ms']:.3f} | {row['p95_ms']:.3f} |"
+        )
+
+    return "\n".join(lines)
+
+def csv_list(cast):
+    return lambda s: [cast(item) for item in s.split(",") if item]
+
+def cli() -> None:
+
+    parser = argparse.ArgumentParser(description="Recall/MRR/latency of the local vector engines against exact search.")
+    parser.add_argument("corpus", nargs="?", default="index/vectors.json", help="vector export (JSON) or .idx index file")
+    parser.add_argument("--queries", help="query vectors (JSON records with 'vector', or a list of vectors)")
+    parser.add_argument("--num-queries", default=200, type=int, help="perturbed corpus rows to use without --queries")
+    parser.add_argument("--noise", default=0.5, type=float, help="perturbation of the generated queries")
+    parser.add_argument("--k", default=10, type=int)
+    parser.add_argument("--precisions", default="float32,float16,int8", type=csv_list(str))
+    parser.add_argument("--rescore-mults", default="4", type=csv_list(int))
+    parser.add_argument("--coarse-dims", default="256,128", type=csv_list(int), help="Matryoshka prefix dims (empty: skip)")
+    parser.add_argument("--nprobe", default="1,4,8,16,32", type=csv_list(int), help="IVF lists probed (empty: skip IVF)")
+    parser.add_argument("--nlist", type=int, help="IVF lists (default 4 x sqrt(n))")
+    parser.add_argument("--json", help="write the report as JSON")
+    parser.add_argument("--markdown", help="write the report as a markdown table")
+    args = parser.parse_args()
+
+    ids, vectors = load_corpus(args.corpus)
+    queries = load_queries(args.queries, vectors, args.num_queries, args.noise)
+    logger.info(f"Evaluating {len(queries)} queries against {len(ids)} vectors from {args.corpus}.")
+
+    report = evaluate(ids, vectors, queries, args.k, args.precisions, args.rescore_mults, args.coarse_dims, args.nprobe, args.nlist)
+    meta = {"corpus": args.corpus, "n": int(len(ids)), "dim": int(vectors.shape[1]), "queries": int(len(queries)), "k": args.k}
+
+    markdown = format_markdown(report, meta)
+    print(markdown)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({**meta, "results": report}, f, ensure_ascii=False, indent=2)
+    if args.markdown:
+        with open(args.markdown, "w", encoding="utf-8") as f:
+            f.write(markdown + "\n")
+
+if __name__ == "__main__":
+    cli()
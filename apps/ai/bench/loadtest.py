@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from loguru import logger
+from typing import Any, Dict, List, Tuple
+from .stubs import LatencyModel, Stubs, SyntheticCorpus, install
+
+# Load test of the real FastAPI app (main.py) with Gemini, Firestore and Prisma replaced by bench/stubs.py.
+# Requests go straight into the ASGI app in this process, so no server, port or HTTP client is involved.
+#
+#   python -m bench.loadtest --replay bench/queries.txt --concurrency 1,8,32,64 --requests 300
+#
+# Reports req/s, latency percentiles, per-stage percentiles (from the Server-Timing header)
+# and event loop lag for every concurrency level. The app's .env settings (engine, precision, ...)
+# apply, except the ones the harness pins below.
+
+PERCENTILES = (50, 95, 99)
+
+def load_replay(replay_path: str, default_count: int) -> List[Dict[str, Any]]:
+    """
+    Request bodies from a replay file: one query per line, or JSON lines of InputData ({"text", "count", ...}).
+    Blank lines and lines starting with # are skipped.
+    """
+    bodies = []
+    with open(replay_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            body = json.loads(line) if line.startswith("{") else {"text": line}
+            body.setdefault("count", default_count)
+            bodies.append(body)
+
+    if not bodies:
+        raise ValueError(f"No queries in {replay_path}.")
+
+    return bodies
+
+async def post_json(app, route: str, payload: Dict[str, Any]) -> Tuple[int, Dict[str, str], bytes]:
+    """
+    One POST through the ASGI interface; returns (status, headers, body). Unhandled app errors count as 500.
+    """
+    body = json.dumps(payload).encode("utf-8")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": route, "raw_path": route.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0), "server": ("bench", 80),
+    }
+    status, headers, chunks = 500, {}, []
+    delivered = False
+    finished = asyncio.Event()
+
+    async def receive():
+        nonlocal delivered
+        if not delivered:
+            delivered = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, headers
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers = {key.decode().lower(): value.decode() for key, value in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                finished.set()
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        status = 500
+    finished.set()
+
+    return status, headers, b"".join(chunks)
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """
+    {"embed": 41.2, ...} in milliseconds from a Server-Timing header value.
+    """
+    timings = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                timings[name] = float(value)
+
+    return timings
+
+async def monitor_lag(samples: List[float], interval: float = 0.01) -> None:
+    """
+    Event loop lag: how much later than requested each short sleep wakes up.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {f"p{p}": float("nan") for p in PERCENTILES}
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+
+async def run_level(app, bodies: List[Dict[str, Any]], concurrency: int, requests: int, route: str) -> Dict[str, Any]:
+    """
+    `requests` requests from `concurrency` closed-loop clients, cycling through the replay bodies.
+    """
+    queue = itertools.islice(itertools.cycle(bodies), requests)
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    statuses: Dict[int, int] = {}
+    degraded = 0
+    lag: List[float] = []
+
+    async def client():
+        nonlocal degraded
+        for body in queue:
+            started = time.perf_counter()
+            status, headers, content = await post_json(app, route, body)
+            latencies.append((time.perf_counter() - started) * 1e3)
+            statuses[status] = statuses.get(status, 0) + 1
+
+            if status == 200:
+                degraded += bool(json.loads(content).get("degraded"))
+                for name, ms in parse_server_timing(headers.get("server-timing", "")).items():
+                    stages.setdefault(name, []).append(ms)
+
+    monitor = asyncio.create_task(monitor_lag(lag))
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status != 200),
+        "degraded": degraded,
+        "rps": len(latencies) / elapsed,
+        "latency_ms": percentiles(latencies),
+        "stages_ms": {name: {**percentiles(values), "n": len(values)} for name, values in stages.items()},
+        "loop_lag_ms": {**percentiles([s * 1e3 for s in lag]), "max": max(lag, default=0.0) * 1e3},
+    }
+
+def format_report(results: List[Dict[str, Any]]) -> str:
+
+    lines = [
+        "| concurrency | req/s | errors | degraded | p50 ms | p95 ms | p99 ms | loop lag p99 ms | loop lag max ms |",
+        "|---:|---:|---:|---:|---:|---:|---:|---:|---:|",
+    ]
+    for r in results:
+        lat, lag = r["latency_ms"], r["loop_lag_ms"]
+        lines.append(
+            f"| {r['concurrency']} | {r['rps']:.1f} | {r['errors']} | {r['degraded']} "
+            f"| {lat['p50']:.1f} | {lat['p95']:.1f} | {lat['p99']:.1f} | {lag['p99']:.2f} | {lag['max']:.2f} |"
+        )
+
+    lines += ["", "| concurrency | stage | n | p50 ms | p95 ms | p99 ms |", "|---:|---|---:|---:|---:|---:|"]
+    for r in results:
+        for name, s in r["stages_ms"].items():
+            lines.append(f"| {r['concurrency']} | {name} | {s['n']} | {s['p50']:.2f} | {s['p95']:.2f} | {s['p99']:.2f} |")
+
+    return "\n".join(lines)
+
+def setup_app(args: argparse.Namespace):
+    """
+    Imports the app with the stubs installed and the synthetic corpus as its local index.
+    Returns (main, search, stubs); the environment must be pinned (pin_environment) beforehand.
+    """
+    # Imported here, after the environment is pinned
+    import main
+    import search
+    from utils import dbhandler
+    from utils.ivf import IVFIndex
+
+    corpus = SyntheticCorpus(n=args.corpus, dim=args.dim)
+    stubs = Stubs(
+        corpus,
+        embed=LatencyModel.parse(args.embed), rerank=LatencyModel.parse(args.rerank),
+        firestore=LatencyModel.parse(args.firestore), db=LatencyModel.parse(args.db),
+        caption_hit_rate=args.caption_hit_rate,
+    )
+    install(stubs, main, search, dbhandler)
+
+    # The local engines search the synthetic corpus with the configured precision
+    index = corpus.index(precision=search.VECTOR_PRECISION, rescore_mult=search.RESCORE_MULT, coarse_dim=search.VECTOR_COARSE_DIM)
+    search._local_index = index
+    if args.engine == "ivf":
+        search._ivf_index, search._ivf_source = IVFIndex.build(index, nprobe=search.IVF_NPROBE), index
+
+    return main, search, stubs
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+
+    from utils.qcache import QueryEmbeddingCache
+
+    main, search, _ = setup_app(args)
+    bodies = load_replay(args.replay, args.count)
+    results = []
+
+    async with main.app.router.lifespan_context(main.app):
+        for concurrency in args.concurrency:
+            # Every level starts with cold caches, so levels stay comparable
+            search.result_cache.invalidate()
+            search.query_cache = QueryEmbeddingCache(maxsize=search.QUERY_CACHE_SIZE, ttl=search.QUERY_CACHE_TTL)
+
+            result = await run_level(main.app, bodies, concurrency, args.requests, args.route)
+            results.append(result)
+            print(f"concurrency {concurrency}: {result['rps']:.1f} req/s, p99 {result['latency_ms']['p99']:.1f} ms", file=sys.stderr)
+
+    return results
+
+def add_app_arguments(parser: argparse.ArgumentParser, rerank: str = "1500:0.4:0.01") -> None:
+    """
+    Options shared by the harnesses that run the app on stubs: replay file, engine, corpus and stub latencies.
+    """
+    parser.add_argument("--replay", default=os.path.join(os.path.dirname(__file__), "queries.txt"), help="queries, one per line (or InputData JSON lines)")
+    parser.add_argument("--count", default=5, type=int, help="results per request if the replay line has no count")
+    parser.add_argument("--engine", default="local", choices=["local", "ivf", "firestore"])
+    parser.add_argument("--corpus", default=20000, type=int, help="synthetic corpus size")
+    parser.add_argument("--dim", default=768, type=int)
+    parser.add_argument("--embed", default="250:0.3", help="median_ms[:sigma[:error_rate[:per_item_ms]]] of the embedding call")
+    parser.add_argument("--rerank", default=rerank, help="... of the Gemini rerank (per_item_ms: per candidate)")
+    parser.add_argument("--firestore", default="80:0.3", help="... of Firestore find_nearest")
+    parser.add_argument("--db", default="20:0.3", help="... of a Prisma caption fetch")
+    parser.add_argument("--caption-hit-rate", default=1.0, type=float, help="share of the corpus in the caption store at startup")
+    parser.add_argument("--log-level", default="ERROR")
+
+def pin_environment(args: argparse.Namespace, no_cache: bool = False) -> None:
+    """
+    Pins what the harness controls before the app modules read their config.
+    """
+    workdir = tempfile.mkdtemp(prefix="m4y-bench-")
+    os.environ["VECTOR_ENGINE"] = args.engine
+    os.environ["CAPTION_SOURCE"] = "db"
+    os.environ["INDEX_RELOAD_SEC"] = "0"
+    os.environ["PROFILE_SAMPLE_RATE"] = "0"
+    os.environ["CLUSTER_PATH"] = os.path.join(workdir, "clusters.json")
+    os.environ["IVF_PATH"] = os.path.join(workdir, "ivf.npz")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    if no_cache:
+        os.environ["QUERY_CACHE_SIZE"] = "0"
+        os.environ["RESULT_CACHE_THRESHOLD"] = "2"
+    os.environ["QUERY_CACHE_PATH"] = ""
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+def cli() -> None:
+
+    parser = argparse.ArgumentParser(description="Load test the AI server with local stand-ins for Gemini, Firestore and Prisma.")
+    add_app_arguments(parser)
+    parser.add_argument("--route", default="/ai/similar")
+    parser.add_argument("--concurrency", default="1,8,32,64", type=lambda s: [int(c) for c in s.split(",")])
+    parser.add_argument("--requests", default=200, type=int, help="requests per concurrency level")
+    parser.add_argument("--no-cache", action="store_true", help="disable the query embedding and semantic result caches")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    pin_environment(args, no_cache=args.no_cache)
+    results = asyncio.run(run(args))
+    print(format_report(results))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    cli()
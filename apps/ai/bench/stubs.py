@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import re
+import numpy as np
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+from utils.qcache import normalize_query
+from utils.schema import GeminiResponse, ImageTrivial, IndvMemeReturn, VectorHit
+from utils.vindex import LocalVectorIndex
+
+# Local stand-ins for the app's external calls (Gemini embed + rerank, Firestore kNN, Prisma),
+# so the real request path can be load-tested without spending quota. install() patches them in.
+
+class LatencyModel(BaseModel):
+    """
+    Log-normal latency around median_ms (sigma 0: constant) plus per_item_ms for each item in the call
+    (e.g. rerank candidates), failing with probability error_rate.
+    Parsed from "median_ms[:sigma[:error_rate[:per_item_ms]]]", e.g. "800:0.4:0.01:20".
+    """
+    median_ms: float = 0.0
+    sigma: float = 0.0
+    error_rate: float = 0.0
+    per_item_ms: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        parts = [float(part) for part in spec.split(":")]
+        return cls(**dict(zip(("median_ms", "sigma", "error_rate", "per_item_ms"), parts)))
+
+    async def wait(self, rng: np.random.Generator, what: str, items: int = 0) -> None:
+
+        latency_ms = self.median_ms * float(np.exp(self.sigma * rng.standard_normal())) + self.per_item_ms * items
+        if latency_ms > 0:
+            await asyncio.sleep(latency_ms / 1e3)
+        if self.error_rate > 0 and rng.random() < self.error_rate:
+            raise RuntimeError(f"Injected {what} failure.")
+
+def _unit(matrix: np.ndarray) -> np.ndarray:
+    return matrix / np.linalg.norm(matrix, axis=-1, keepdims=True)
+
+def _text_rng(text: str) -> np.random.Generator:
+    seed = int.from_bytes(hashlib.blake2b(normalize_query(text).encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.default_rng(seed)
+
+class SyntheticCorpus:
+    """
+    n unit vectors in topic clusters of varying size (geometric, mean mean_cluster), with captions,
+    plus deterministic query embeddings: a query's text picks a topic and lands near its centroid.
+    Small topics give a clear winner group followed by a score drop, large ones a flat score curve,
+    so adaptive candidate depth has something to detect.
+
+    judge() stands in for the Gemini rerank: cosine to the query plus judge_noise of per-(query, image) noise,
+    so it mostly agrees with vector search but reorders close candidates.
+    """
+
+    def __init__(self, n: int = 20000, dim: int = 768, seed: int = 0, mean_cluster: float = 15.0, judge_noise: float = 0.05):
+
+        rng = np.random.default_rng(seed)
+        self.dim = dim
+        self.judge_noise = judge_noise
+        self.ids = np.arange(1, n + 1, dtype=np.int64)
+
+        sizes = []
+        while sum(sizes) < n:
+            sizes.append(int(rng.geometric(1.0 / mean_cluster)))
+        self.topics = np.repeat(np.arange(len(sizes)), sizes)[:n]
+        self.centroids = _unit(rng.standard_normal((len(sizes), dim))).astype(np.float32)
+
+        # Members sit at cosine ~0.55-0.8 from their centroid
+        spread = rng.uniform(0.8, 1.5, size=(n, 1)).astype(np.float32)
+        noise = rng.standard_normal((n, dim)).astype(np.float32) / np.sqrt(dim)
+        self.vectors = _unit(self.centroids[self.topics] + spread * noise).astype(np.float32)
+
+    def index(self, **kwargs) -> LocalVectorIndex:
+        return LocalVectorIndex(self.ids, self.vectors, **kwargs)
+
+    def caption(self, image_id: int) -> ImageTrivial:
+        return ImageTrivial(
+            image_id=image_id,
+            caption=f"밈 {image_id}: 합성 캡션 " + "가나다라마바사 " * 8,
+            rerank_caption=f"밈 {image_id} 요약",
+            like_cnt=image_id % 97,
+        )
+
+    def embed(self, text: str) -> List[float]:
+
+        rng = _text_rng(text)
+        topic = self.topics[rng.integers(len(self.ids))]
+        vector = self.centroids[topic] + 0.7 * rng.standard_normal(self.dim).astype(np.float32) / np.sqrt(self.dim)
+
+        return _unit(vector).tolist()
+
+    def judge(self, text: str, image_ids: Optional[List[int]] = None) -> np.ndarray:
+        """
+        Judge relevance of the given images (all images if None) to the query text.
+        The noise is fixed per (query, image), so a candidate scores the same in every candidate list.
+        """
+        rows = self.ids - 1 if image_ids is None else np.asarray(image_ids, dtype=np.int64) - 1
+        noise = np.random.default_rng(_text_rng(text).integers(2**63)).standard_normal(len(self.ids)).astype(np.float32)
+
+        return self.vectors[rows] @ np.asarray(self.embed(text), dtype=np.float32) + self.judge_noise * noise[rows]
+
+class Stubs:
+    """
+    Latency-modelled replacements for every outbound call of the request path.
+    Prisma's startup load sees only caption_hit_rate of the corpus, so the rest is fetched per request.
+    """
+
+    def __init__(
+        self, corpus: SyntheticCorpus,
+        embed: LatencyModel, rerank: LatencyModel, firestore: LatencyModel, db: LatencyModel,
+        caption_hit_rate: float = 1.0, seed: int = 0
+    ):
+        self.corpus = corpus
+        self.embed_latency = embed
+        self.rerank_latency = rerank
+        self.firestore_latency = firestore
+        self.db_latency = db
+        self.caption_hit_rate = caption_hit_rate
+        self.rng = np.random.default_rng(seed)
+        # Candidates in the latest rerank prompt of each query text
+        self.prompt_sizes: Dict[str, int] = {}
+        self._exact: Optional[LocalVectorIndex] = None
+
+    # Gemini embeddings
+    async def agenerate_embedding_gemini(self, texts: List[str], task_type: str = "RETRIEVAL_QUERY", **kwargs) -> List[List[float]]:
+
+        await self.embed_latency.wait(self.rng, "embedding")
+        return [self.corpus.embed(text) for text in texts]
+
+    # Gemini rerank: orders the prompt's candidates by the corpus judge; latency grows with the candidate count
+    async def gemini_call(self, sys_prompt: str, user_input: str, user_prompt: str) -> Optional[GeminiResponse]:
+
+        ids = [int(image_id) for image_id in re.findall(r"- ID: (\d+)", user_prompt)]
+        query = re.search(r"이용자의 현재 상황: (.*)", user_input)
+        text = query.group(1).strip() if query else ""
+        self.prompt_sizes[text] = len(ids)
+        try:
+            await self.rerank_latency.wait(self.rng, "rerank", items=len(ids))
+        except RuntimeError:
+            # The real gemini_call logs and returns None on API errors
+            return None
+
+        if text and ids:
+            relevance = self.corpus.judge(text, ids)
+            ids = [ids[i] for i in np.argsort(-relevance, kind="stable")]
+
+        count = re.search(r"상위 (\d+)개", sys_prompt)
+        ids = ids[:int(count.group(1))] if count else ids
+
+        return GeminiResponse(text=[IndvMemeReturn(image_id=image_id, rank=rank) for rank, image_id in enumerate(ids, start=1)])
+
+    # Firestore find_nearest, answered exactly from the synthetic corpus
+    async def vsearch_fs(self, query_vector: List[float], k: int = 5) -> List[VectorHit]:
+
+        await self.firestore_latency.wait(self.rng, "Firestore")
+        if self._exact is None:
+            self._exact = self.corpus.index()
+
+        return self._exact.search(query_vector, k)
+
+    # Prisma caption fetch
+    async def fetch_captions(self, ids: Optional[List[int]] = None) -> Dict[int, ImageTrivial]:
+
+        await self.db_latency.wait(self.rng, "DB")
+        if ids is None:
+            cutoff = int(len(self.corpus.ids) * self.caption_hit_rate)
+            ids = self.corpus.ids[:cutoff].tolist()
+
+        return {int(image_id): self.corpus.caption(int(image_id)) for image_id in ids}
+
+    async def caption_watermark(self) -> str:
+        return "bench"
+
+class StubPrisma:
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+def install(stubs: Stubs, main_module, search_module, dbhandler_module) -> None:
+    """
+    Patches the stubs into the imported app modules, where the request path looks them up at call time.
+    """
+    search_module.agenerate_embedding_gemini = stubs.agenerate_embedding_gemini
+    search_module.gemini_call = stubs.gemini_call
+    search_module.vsearch_fs = stubs.vsearch_fs
+    search_module.VECTOR_ENGINES["firestore"] = stubs.vsearch_fs
+
+    dbhandler_module.fetch_captions = stubs.fetch_captions
+    dbhandler_module.caption_watermark = stubs.caption_watermark
+    main_module.db = StubPrisma()
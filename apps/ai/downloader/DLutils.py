@@ -1,7 +1,11 @@
 from PIL import Image
 from pydantic import BaseModel
+from typing import Optional
+from utils.imagehash import dhash
+from preps.dblite import find_similar_hash
 import requests
 import io
+import sqlite3
 from loguru import logger
 import os
 
@@ -13,11 +17,15 @@ class ImageDL(BaseModel):
     success: bool
     width: int
     height: int
+    dhash: Optional[int] = None
+    duplicate_of: Optional[int] = None
 
-def download_image(url: str, save_path: str) -> ImageDL:
+def download_image(url: str, save_path: str, dedup: bool = True) -> ImageDL:
     """
     Download image to given path by url.
-    Returns an ImageDL object indicating success and image dimensions.
+    Returns an ImageDL object indicating success, image dimensions and the image's dHash.
+    With dedup, an image whose dHash is near one already in the prep DB is not saved
+    (success=False, duplicate_of set), so reposts never reach the paid captioning step.
     """
     try:
         # Send a GET request to the URL with a timeout
@@ -30,6 +38,14 @@ def download_image(url: str, save_path: str) -> ImageDL:
         # Open the image using PIL to get dimensions and save
         with Image.open(img_bytes) as image:
             width, height = image.size
+
+            # Content-level de-duplication: the same meme under a different CDN URL
+            image_hash = dhash(image)
+            if dedup:
+                duplicate_of = find_similar_hash(image_hash)
+                if duplicate_of is not None:
+                    logger.info(f"Skipping {url}: near-duplicate of image {duplicate_of}.")
+                    return ImageDL(success=False, width=width, height=height, dhash=image_hash, duplicate_of=duplicate_of)
             
             # Ensure the image is in a saveable format (like RGB for JPEG)
             if image.mode in ("RGBA", "P"):
@@ -41,8 +57,11 @@ def download_image(url: str, save_path: str) -> ImageDL:
             # Save the image to the specified path as JPEG
             image.save(save_path, 'jpeg')
 
-        return ImageDL(success=True, width=width, height=height)
+        return ImageDL(success=True, width=width, height=height, dhash=image_hash)
 
+    except sqlite3.Error:
+        # A broken prep DB fails every download alike; surface it instead of dropping each image as a bad download
+        raise
     except Exception as e:
         logger.error(f"Failed to download or process image from {url}: {e}")
         return ImageDL(success=False, width=0, height=0)
@@ -86,7 +86,7 @@ def browse_account(
             dl_response: ImageDL = download_image(url=img_url, save_path=save_path)
 
             if dl_response.success:
-                add_meme(original_url=img_url, width=dl_response.width, height=dl_response.height, src_url=post_url)
+                add_meme(original_url=img_url, width=dl_response.width, height=dl_response.height, src_url=post_url, dhash=dl_response.dhash)
                 logger.info(f"[{id_cursor}] Saved {save_path} from {post_url}")
                 id_cursor += 1
 
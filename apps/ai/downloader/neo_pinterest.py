@@ -148,7 +148,7 @@ def run_pinterest_scrape(start_id: int, base_path: str) -> int:
     for url in urls:
 
         # Parse raw image URL
-        raw_image_url = url['original_url']
+        raw_image_url = url.original_url
 
         # Set download path
         save_path = path.join(base_path, f"{id_cursor}.jpg")
@@ -157,8 +157,8 @@ def run_pinterest_scrape(start_id: int, base_path: str) -> int:
         dl_response: ImageDL = download_image(url=raw_image_url, save_path=save_path)
 
         # If success, add row to prep DB
-        if dl_response['success']:
-            add_meme(original_url=raw_image_url, width=dl_response['width'], height=dl_response['height'], src_url=url['src_url'])
+        if dl_response.success:
+            add_meme(original_url=raw_image_url, width=dl_response.width, height=dl_response.height, src_url=url.src_url, dhash=dl_response.dhash)
             id_cursor += 1
 
     return id_cursor
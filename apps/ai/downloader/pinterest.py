@@ -153,6 +153,7 @@ def run_pinterest_scrape(start_id: int, base_path: str, max: int = 50) -> int:
                     width=dl_response.width,
                     height=dl_response.height,
                     src_url=src_url,
+                    dhash=dl_response.dhash,
                 )
                 logger.info(f"[{id_cursor}] Saved {save_path} from {orig_url}")
                 id_cursor += 1
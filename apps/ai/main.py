@@ -1,11 +1,82 @@
-from fastapi import FastAPI
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from dotenv import load_dotenv
 from loguru import logger
-from search import final_eval
-from utils.schema import InputData, FullRecReturn
+from os import getenv, path
+from typing import List, Optional
+from search import final_eval, eval_stages, batch_eval, get_local_index, get_ivf_index, get_clusters, reload_index, watch_index, query_cache, local_index_in_use, tag_filters_available, VECTOR_ENGINE, INDEX_RELOAD_SEC
+from utils.profiling import track_timings, server_timing, sample_stacks
+from utils.metrics import render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from utils.dbhandler import db, load_caption_store, refresh_caption_store, CAPTION_SOURCE
+from utils.schema import InputData, BatchInputData, FullRecReturn, BatchRecReturn, StreamRecReturn, RankedResponse, IndexStatus
+
+load_dotenv()
+
+# Shared secret for /ai/admin/* and on-demand profiles (X-Admin-Token header); both are refused if unset
+ADMIN_TOKEN = getenv("ADMIN_TOKEN")
+# Share of /ai/similar requests profiled into PROFILE_DIR as folded stacks (0: only on an X-Profile header), and the sampling interval;
+# only the newest PROFILE_KEEP profiles are kept
+PROFILE_SAMPLE_RATE = float(getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(getenv("PROFILE_KEEP", "50"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+
+    # Connect Prisma once and reuse it for every request
+    await db.connect()
+    logger.info("Connected to Prisma.")
+
+    # Preload candidate captions, and keep them fresh in the background
+    await load_caption_store()
+    refresher = asyncio.create_task(refresh_caption_store())
+
+    # Load the local vector (and IVF) index and duplicate clusters before serving, not on the first request
+    # (CAPTION_SOURCE=index also reads its captions from the index file; tag filters search it under any engine)
+    if VECTOR_ENGINE == "ivf":
+        await asyncio.to_thread(get_ivf_index)
+    elif local_index_in_use():
+        await asyncio.to_thread(get_local_index)
+    await asyncio.to_thread(get_clusters)
+
+    # Swap in new index snapshots as the pipeline publishes them
+    watcher = None
+    if local_index_in_use() and INDEX_RELOAD_SEC > 0:
+        watcher = asyncio.create_task(watch_index())
+
+    yield
+
+    if watcher:
+        watcher.cancel()
+    refresher.cancel()
+    await query_cache.close()
+    await db.disconnect()
+    logger.info("Disconnected from Prisma.")
+
+def should_profile(x_profile: Optional[str], x_admin_token: Optional[str]) -> bool:
+    """
+    X-Profile: 1 asks for a profile, honored only with the admin token (never if ADMIN_TOKEN is unset);
+    otherwise PROFILE_SAMPLE_RATE decides.
+    """
+    if x_profile:
+        return bool(ADMIN_TOKEN) and x_admin_token == ADMIN_TOKEN
+
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def check_tag_filter(include_tags: Optional[List[str]], exclude_tags: Optional[List[str]]) -> None:
+    """
+    Rejects tag-filtered requests when this server keeps no local index to filter (TAG_FILTERS=false under firestore).
+    """
+    if (include_tags or exclude_tags) and not tag_filters_available():
+        raise HTTPException(status_code=400, detail="Tag filters are disabled on this server (TAG_FILTERS=false).")
 
 # Initialize FastAPI app
-app = FastAPI(title="memeforyou AI API - GDGoC KU 2025 worktree")
+app = FastAPI(title="memeforyou AI API - GDGoC KU 2025 worktree", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,20 +86,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(asyncio.TimeoutError)
+async def budget_exceeded(request: Request, exc: asyncio.TimeoutError) -> JSONResponse:
+    """
+    The query embedding (retries included) did not finish within REQUEST_BUDGET_SEC; later stages degrade instead.
+    """
+    logger.error(f"{request.url.path} ran out of its request budget while embedding.")
+    return JSONResponse(status_code=504, content={"detail": "Embedding the query exceeded the request budget."})
+
 @app.post("/ai/similar",
           response_model=FullRecReturn,
           summary="Get top N ranked meme recommendation results.",
-          description="")
-async def search_meme(request: InputData):
+          description="The Server-Timing header carries per-stage durations. X-Profile: 1 writes a folded-stack profile of the request to PROFILE_DIR, named in the X-Profile response header.")
+async def search_meme(request: InputData, response: Response, x_profile: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
 
     logger.info(f"Recognized request: {request.count} results with {request.text}")
+    check_tag_filter(request.include_tags, request.exclude_tags)
+
+    interval = PROFILE_INTERVAL_MS / 1e3
+    with track_timings() as timings:
+        async with sample_stacks(should_profile(x_profile, x_admin_token), PROFILE_DIR, "similar", interval, keep=PROFILE_KEEP) as sampler:
+            search_response = await final_eval(
+                user_input=request.text, final_cnt=request.count,
+                include_tags=request.include_tags, exclude_tags=request.exclude_tags, nprobe=request.nprobe
+            )
 
-    search_response = await final_eval(user_input=request.text, final_cnt=request.count)
+    response.headers["Server-Timing"] = server_timing(timings)
+    if sampler is not None and sampler.path:
+        response.headers["X-Profile"] = path.basename(sampler.path)
 
     # Construct return
     result = FullRecReturn(
         count=len(search_response.text),
-        recommendations=search_response.text
+        recommendations=search_response.text,
+        degraded=search_response.degraded
     )
 
     if result:
@@ -36,4 +127,101 @@ async def search_meme(request: InputData):
     else:
         logger.error(f"Failed to acquire recommendations.")
 
-    return result
\ No newline at end of file
+    return result
+
+@app.post("/ai/similar/stream",
+          summary="Stream meme recommendations: vector search hits first, Gemini-ranked results second.",
+          description="NDJSON; each line is a StreamRecReturn. stage=vector is preliminary, stage=final is the ranked result. "
+                      "Failures before the first line are returned as an error status; later ones as a stage=error line.")
+async def search_meme_stream(request: InputData):
+
+    logger.info(f"Recognized streaming request: {request.count} results with {request.text}")
+    check_tag_filter(request.include_tags, request.exclude_tags)
+
+    def line(stage: str, response: RankedResponse) -> str:
+        chunk = StreamRecReturn(
+            stage=stage,
+            count=len(response.text),
+            recommendations=response.text,
+            degraded=response.degraded
+        )
+        return chunk.model_dump_json() + "\n"
+
+    stages = eval_stages(
+        user_input=request.text, final_cnt=request.count,
+        include_tags=request.include_tags, exclude_tags=request.exclude_tags, nprobe=request.nprobe
+    )
+
+    # Run up to the first stage before sending headers, so embedding/search/DB failures still get a proper status
+    try:
+        first = await anext(stages)
+    except Exception:
+        await stages.aclose()
+        raise
+
+    async def chunks():
+        try:
+            yield line(*first)
+            async for stage, response in stages:
+                yield line(stage, response)
+        except Exception as e:
+            logger.error(f"Streaming request failed after the first stage: {e}")
+            yield StreamRecReturn(stage="error", count=0, recommendations=[], error="Ranking failed; use the preliminary result.").model_dump_json() + "\n"
+        finally:
+            await stages.aclose()
+
+    return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+@app.post("/ai/similar/batch",
+          response_model=BatchRecReturn,
+          summary="Get top N ranked meme recommendation results for each of several texts.",
+          description="Embedding, vector search and metadata lookup are shared across all texts; results keep the input order.")
+async def search_meme_batch(request: BatchInputData, response: Response):
+
+    logger.info(f"Recognized batch request: {len(request.texts)} texts, {request.count} results each")
+    check_tag_filter(request.include_tags, request.exclude_tags)
+
+    with track_timings() as timings:
+        search_responses = await batch_eval(
+            user_inputs=request.texts, final_cnt=request.count,
+            include_tags=request.include_tags, exclude_tags=request.exclude_tags, nprobe=request.nprobe
+        )
+
+    response.headers["Server-Timing"] = server_timing(timings)
+
+    result = BatchRecReturn(results=[
+        FullRecReturn(
+            count=len(response.text),
+            recommendations=response.text,
+            degraded=response.degraded
+        )
+        for response in search_responses
+    ])
+
+    logger.success(f"Successfully acquired batch recommendations.")
+
+    return result
+
+@app.post("/ai/admin/reload-index",
+          response_model=IndexStatus,
+          summary="Load the current index snapshot in the background and swap it in.",
+          description="Requests keep being served from the old index until the swap. force reloads even if nothing changed. "
+                      "Requires X-Admin-Token (403 if ADMIN_TOKEN is unset); 409 when no local index is in use.")
+async def admin_reload_index(force: bool = False, x_admin_token: Optional[str] = Header(None)):
+
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+    if not local_index_in_use():
+        raise HTTPException(status_code=409, detail="No local index is in use (VECTOR_ENGINE=firestore).")
+
+    reloaded = await reload_index(force=force)
+    index = await asyncio.to_thread(get_local_index)
+
+    return IndexStatus(version=index.version, vectors=len(index), reloaded=reloaded)
+
+@app.get("/metrics",
+         summary="Prometheus metrics: per-stage latency histograms, cache lookups, candidate counts, prompt sizes and degraded responses.",
+         description="Text exposition format. With PROMETHEUS_MULTIPROC_DIR set, covers every uvicorn worker; otherwise only the worker that answers.")
+async def metrics():
+
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
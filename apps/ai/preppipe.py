@@ -7,6 +7,8 @@ import os
 from downloader.DLmanager import managed_download
 from preps.captioner import captioner_operation
 from preps.embedder import embedder_operation, embed_rows
+from preps.dedup import dedup_operation, backfill_image_hashes
+from preps.ivfbuild import ivf_build_operation
 import preps.dblite as db
 from preps.init_sqlite import init_db
 
@@ -16,6 +18,8 @@ COMMANDS = {
     "Download New Memes": lambda: worker_download(),
     "Run Captioner": lambda: worker_caption(),
     "Run Embedder": lambda: worker_embed(),
+    "Cluster Duplicates": lambda: worker_dedup(),
+    "Build IVF Index": lambda: worker_ivf(),
     "Run FULL Pipeline": lambda: worker_fullpipe(),
     "Export JSON": lambda: worker_export(),
     "Show local DB Status": lambda: worker_dbstat(),
@@ -63,6 +67,8 @@ def worker_init_db():
 MANAGE_COMMANDS = {
     "View DB": lambda: manage_db_viewer(),
     "Update Image(s) Status": lambda: manage_db_updater(),
+    "Backfill Rerank Captions": lambda: manage_db_backfill(),
+    "Backfill Image Hashes": lambda: manage_db_hash_backfill(),
     "Delete Image(s)": lambda: manage_db_deleter(),
     "Flush DB": lambda: manage_db_flusher(),
     "Return to main menu": lambda: ...
@@ -192,6 +198,36 @@ def manage_db_updater():
 
     return res
 
+def manage_db_backfill():
+
+    res = 0
+
+    try:
+        logger.info("Calling dblite to backfill rerank captions...")
+        db.backfill_rerank_captions()
+        logger.success("Backfill completed.")
+
+    except Exception as e:
+        logger.error(f"Backfill failed: {e}")
+        res = 1
+
+    return res
+
+def manage_db_hash_backfill():
+
+    res = 0
+
+    try:
+        logger.info("Hashing downloaded images...")
+        backfill_image_hashes()
+        logger.success("Hash backfill completed.")
+
+    except Exception as e:
+        logger.error(f"Hash backfill failed: {e}")
+        res = 1
+
+    return res
+
 def manage_db_deleter():
 
     res = 0
@@ -321,6 +357,41 @@ def worker_embed():
 
     return res
 
+def worker_dedup():
+
+    res = 0
+
+    use_hashes = questionary.confirm(
+        "Also compare image perceptual hashes (needs images/ locally)?",
+        default=True
+    ).ask()
+
+    try:
+        logger.info(f"Calling dedup...")
+        dedup_operation(use_hashes=use_hashes)
+        logger.success(f"Duplicate clustering completed.")
+
+    except Exception as e:
+        logger.error(f"Duplicate clustering failed: {e}")
+        res = 1
+
+    return res
+
+def worker_ivf():
+
+    res = 0
+
+    try:
+        logger.info(f"Building IVF index...")
+        ivf_build_operation()
+        logger.success(f"IVF index build completed.")
+
+    except Exception as e:
+        logger.error(f"IVF index build failed: {e}")
+        res = 1
+
+    return res
+
 def worker_fullpipe():
 
     res = 0
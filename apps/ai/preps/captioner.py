@@ -2,6 +2,7 @@ from google import genai
 from google.genai import types
 from sqlite3 import Row
 from utils.schema import IndvCaption, BatchCaption
+from utils.captions import compact_caption
 from .dblite import get_memes, update_captioned
 from itertools import batched
 from loguru import logger
@@ -125,7 +126,7 @@ def caption_rows(target_rows: list, base_path: str) -> List[IndvCaption]:
 
     return local_captioned_rows
 
-def caption_converter(before_rows: List[IndvCaption]) -> Tuple[List[int], List[str], List[List[str]]]:
+def caption_converter(before_rows: List[IndvCaption]) -> Tuple[List[int], List[str], List[List[str]], List[str]]:
     """
     Convert the list of IndvCaption into updater compatible format
     """
@@ -133,15 +134,18 @@ def caption_converter(before_rows: List[IndvCaption]) -> Tuple[List[int], List[s
     ids: List[int] = []
     captions: List[str] = []
     tags: List[List[str]] = []
+    rerank_captions: List[str] = []
 
     for row in before_rows:
         ids.append(row.image_id)
         # Combine ocr, caption, and humor into a single string for the database
         full_caption = f"OCR: {row.ocr}, Caption: {row.caption}, Humor: {row.humor}"
         captions.append(full_caption)
+        # Token-budgeted version of the same, used in the rerank prompt
+        rerank_captions.append(compact_caption(row.ocr, row.caption, row.humor))
         tags.append(row.tags)
 
-    return ids, captions, tags
+    return ids, captions, tags, rerank_captions
 
 def captioner_operation() -> None:
     """
@@ -158,8 +162,8 @@ def captioner_operation() -> None:
 
         if this_batch_captions:
             # Convert and update the database for this batch
-            image_ids, captions, tags_list = caption_converter(before_rows=this_batch_captions)
-            update_captioned(image_ids=image_ids, captions=captions, tags_list=tags_list)
+            image_ids, captions, tags_list, rerank_captions = caption_converter(before_rows=this_batch_captions)
+            update_captioned(image_ids=image_ids, captions=captions, tags_list=tags_list, rerank_captions=rerank_captions)
             logger.success(f"Successfully updated {len(image_ids)} memes in the database for batch {i+1}.")
         else:
             logger.warning(f"No rows were successfully captioned in batch {i+1}. Nothing to update.")
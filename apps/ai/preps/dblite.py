@@ -1,22 +1,40 @@
 import sqlite3
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import json
 from loguru import logger
 from preps.init_sqlite import init_db
+from utils.captions import compact_from_full
 import os
 
 DB_PATH = os.path.join("prepdb.sqlite3")
+# Two images whose dHashes differ in at most this many bits are the same meme.
+# Lookups split the hash into 4 bands, so any match within 3 bits shares a band exactly (pigeonhole).
+HASH_MAX_HAMMING = 3
+# Bound parameters per statement; older SQLite builds cap them at 999
+SQLITE_MAX_PARAMS = 900
+
+# Whether this process already brought the schema up to date (init_db's CREATE ... IF NOT EXISTS migrations)
+_schema_ready = False
 
 # --- Database helpers ---
 def _get_conn():
-    """Get a new SQLite connection."""
+    """Get a new SQLite connection; the first one per process migrates older prep DBs (e.g. adds ImageHash)."""
+    global _schema_ready
+    if not _schema_ready:
+        init_db()
+        _schema_ready = True
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
+def _hash_row(dhash: int) -> Tuple[int, int, int, int, int]:
+    """(signed dhash, b0..b3) as stored in ImageHash; SQLite integers are signed 64-bit."""
+    signed = dhash - (1 << 64) if dhash >= (1 << 63) else dhash
+    return (signed, *[(dhash >> (16 * band)) & 0xFFFF for band in range(4)])
+
 # For DLmanager.py
-def add_meme(original_url: str, width: int, height: int, src_url: str) -> int:
-    """Adds a new meme to the database with PENDING status."""
+def add_meme(original_url: str, width: int, height: int, src_url: str, dhash: Optional[int] = None) -> int:
+    """Adds a new meme to the database with PENDING status, along with its perceptual hash if given."""
     with _get_conn() as conn:
         cursor = conn.cursor()
         cursor.execute(
@@ -26,8 +44,49 @@ def add_meme(original_url: str, width: int, height: int, src_url: str) -> int:
             """,
             (original_url, width, height, src_url)
         )
+        image_id = cursor.lastrowid
+        if dhash is not None:
+            cursor.execute(
+                "INSERT OR REPLACE INTO ImageHash (image_id, dhash, b0, b1, b2, b3) VALUES (?, ?, ?, ?, ?, ?)",
+                (image_id, *_hash_row(dhash))
+            )
+        conn.commit()
+        return image_id
+
+def add_hashes(hashes: Dict[int, int]) -> None:
+    """Stores perceptual hashes for existing images (image_id -> dhash)."""
+    with _get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR REPLACE INTO ImageHash (image_id, dhash, b0, b1, b2, b3) VALUES (?, ?, ?, ?, ?, ?)",
+            [(image_id, *_hash_row(dhash)) for image_id, dhash in hashes.items()]
+        )
         conn.commit()
-        return cursor.lastrowid
+
+def get_unhashed_image_ids() -> List[int]:
+    """Image ids with no ImageHash row yet (downloaded before hashing existed)."""
+    with _get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT image_id FROM Image WHERE image_id NOT IN (SELECT image_id FROM ImageHash) ORDER BY image_id"
+        )
+        return [row['image_id'] for row in cursor.fetchall()]
+
+def find_similar_hash(dhash: int, max_distance: int = HASH_MAX_HAMMING) -> Optional[int]:
+    """
+    Returns the image_id of a stored image within max_distance bits of dhash, or None.
+    Candidates come from the band indexes, then get verified by exact Hamming distance.
+    """
+    _, *bands = _hash_row(dhash)
+    with _get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT image_id, dhash FROM ImageHash WHERE b0 = ? OR b1 = ? OR b2 = ? OR b3 = ?", bands
+        )
+        for row in cursor.fetchall():
+            if ((row['dhash'] & 0xFFFFFFFFFFFFFFFF) ^ dhash).bit_count() <= max_distance:
+                return row['image_id']
+    return None
 
 # Retrieve memes by status
 def get_memes(status: str) -> List[sqlite3.Row]:
@@ -37,14 +96,41 @@ def get_memes(status: str) -> List[sqlite3.Row]:
         cursor.execute("SELECT * FROM Image WHERE status = ?", (status,))
         return cursor.fetchall()
 
+# For embedder.py's index file
+def get_serving_captions(image_ids: List[int]) -> Dict[int, Dict]:
+    """Caption fields the serving side needs (caption, rerank_caption, like_cnt, tags), keyed by image_id."""
+    with _get_conn() as conn:
+        cursor = conn.cursor()
+        captions: Dict[int, Dict] = {}
+        # One joined query per chunk (one row per tag), within SQLite's bound-parameter limit
+        for start in range(0, len(image_ids), SQLITE_MAX_PARAMS):
+            chunk = image_ids[start:start + SQLITE_MAX_PARAMS]
+            cursor.execute(
+                f"""
+                SELECT i.image_id, i.caption, i.rerank_caption, i.like_cnt, t.tag
+                FROM Image i LEFT JOIN ImageTag t ON t.image_id = i.image_id
+                WHERE i.image_id IN ({", ".join("?" * len(chunk))}) AND i.caption IS NOT NULL
+                ORDER BY i.image_id, t.image_tag_id
+                """,
+                chunk
+            )
+            for row in cursor.fetchall():
+                entry = captions.setdefault(row['image_id'], {
+                    "image_id": row['image_id'], "caption": row['caption'],
+                    "rerank_caption": row['rerank_caption'], "like_cnt": row['like_cnt'], "tags": []
+                })
+                if row['tag'] is not None:
+                    entry["tags"].append(row['tag'])
+        return captions
+
 # For captioner.py
-def update_captioned(image_ids: List[int], captions: List[str], tags_list: List[List[str]]) -> None:
-    """Updates memes with captions and tags, sets status to CAPTIONED."""
+def update_captioned(image_ids: List[int], captions: List[str], tags_list: List[List[str]], rerank_captions: List[str]) -> None:
+    """Updates memes with captions, compact rerank captions and tags, sets status to CAPTIONED."""
     with _get_conn() as conn:
         cursor = conn.cursor()
-        update_data = [(caption, image_id) for caption, image_id in zip(captions, image_ids)]
+        update_data = [(caption, rerank_caption, image_id) for caption, rerank_caption, image_id in zip(captions, rerank_captions, image_ids)]
         cursor.executemany(
-            "UPDATE Image SET caption = ?, status = 'CAPTIONED' WHERE image_id = ?", update_data
+            "UPDATE Image SET caption = ?, rerank_caption = ?, status = 'CAPTIONED' WHERE image_id = ?", update_data
         )
 
         all_tags_data = []
@@ -101,6 +187,7 @@ def export_json(images_path: str, tags_path: str) -> None:
                 "src_url": image_row['src_url'],
                 "cloud_url": makeshift_cloud_url,
                 "caption": image_row['caption'],
+                "rerank_caption": image_row['rerank_caption'],
                 "width": image_row['width'],
                 "height": image_row['height'],
                 "like_cnt": image_row['like_cnt'],
@@ -129,6 +216,19 @@ def get_status_counts() -> Dict[str, int]:
 
     return counts
 
+def backfill_rerank_captions() -> int:
+    """Fills rerank_caption for captioned rows that predate it. Returns the number of rows updated."""
+    with _get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT image_id, caption FROM Image WHERE caption IS NOT NULL AND rerank_caption IS NULL")
+        update_data = [(compact_from_full(row['caption']), row['image_id']) for row in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE Image SET rerank_caption = ? WHERE image_id = ?", update_data
+        )
+        conn.commit()
+        logger.info(f"Backfilled rerank captions for {len(update_data)} rows.")
+        return len(update_data)
+
 def get_all_img_urls() -> List[str]:
     """
     Get all image urls for dedup
@@ -0,0 +1,143 @@
+from utils.imagehash import dhash
+from PIL import Image
+from loguru import logger
+from dotenv import load_dotenv
+from os import getenv, makedirs, path
+from typing import Dict, List, Optional
+import json
+import numpy as np
+
+load_dotenv()
+
+# Input vectors (embedder.py's local export) and output image_id -> cluster_id map
+VECTOR_INDEX_PATH = getenv("VECTOR_INDEX_PATH", "index/vectors.json")
+CLUSTER_PATH = getenv("CLUSTER_PATH", "index/clusters.json")
+# Caption embeddings at least this similar are treated as the same meme
+CLUSTER_THRESHOLD = float(getenv("CLUSTER_THRESHOLD", "0.97"))
+# dHashes at most this many bits apart are treated as the same image
+CLUSTER_MAX_HAMMING = int(getenv("CLUSTER_MAX_HAMMING", "4"))
+BPATH = "images/"
+
+class _UnionFind:
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+def cluster_duplicates(
+    ids: List[int],
+    vectors: np.ndarray,
+    threshold: float = CLUSTER_THRESHOLD,
+    hashes: Optional[np.ndarray] = None,
+    max_hamming: int = CLUSTER_MAX_HAMMING,
+    block: int = 1024
+) -> Dict[int, int]:
+    """
+    Groups near-duplicate memes, returning image_id -> cluster_id (the smallest image_id in its cluster).
+
+    :param ids: image_ids, aligned with the rows of vectors.
+    :param vectors: unit caption embeddings, one row per image.
+    :param threshold: cosine similarity at or above which two images are linked.
+    :param hashes: optional uint64 dHashes aligned with ids (0 = unknown); links images within max_hamming bits.
+    :param block: rows compared per matmul, to bound memory on large corpora.
+    """
+    n = len(ids)
+    uf = _UnionFind(n)
+
+    # Work in image_id order so the union-find root is the smallest id
+    order = np.argsort(np.asarray(ids))
+    ids = [ids[i] for i in order]
+    vectors = np.ascontiguousarray(vectors[order], dtype=np.float32)
+    if hashes is not None:
+        hashes = np.asarray(hashes, dtype=np.uint64)[order]
+
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+
+        # Upper triangle only: compare this block against itself and everything after it
+        sims = vectors[start:stop] @ vectors[start:].T
+        rows, cols = np.nonzero(sims >= threshold)
+        for r, c in zip(rows, cols):
+            i, j = start + r, start + c
+            if j > i:
+                uf.union(i, j)
+
+        if hashes is not None:
+            dists = np.bitwise_count(hashes[start:stop, None] ^ hashes[None, start:])
+            known = (hashes[start:stop, None] != 0) & (hashes[None, start:] != 0)
+            rows, cols = np.nonzero((dists <= max_hamming) & known)
+            for r, c in zip(rows, cols):
+                i, j = start + r, start + c
+                if j > i:
+                    uf.union(i, j)
+
+    return {ids[i]: ids[uf.find(i)] for i in range(n)}
+
+def load_hashes(ids: List[int], base_path: str = BPATH) -> np.ndarray:
+    """
+    dHashes of the downloaded images, 0 where the file is missing or unreadable.
+    """
+    hashes = np.zeros(len(ids), dtype=np.uint64)
+
+    for i, image_id in enumerate(ids):
+        img_path = path.join(base_path, f"{image_id}.jpg")
+        try:
+            with Image.open(img_path) as image:
+                hashes[i] = dhash(image)
+        except Exception as e:
+            logger.trace(f"No hash for {image_id}: {e}")
+
+    return hashes
+
+def backfill_image_hashes(base_path: str = BPATH) -> int:
+    """
+    Hashes already-downloaded images that have no ImageHash row yet, so download-time dedup covers them.
+    """
+    from .dblite import add_hashes, get_unhashed_image_ids
+
+    ids = get_unhashed_image_ids()
+    hashes = load_hashes(ids, base_path=base_path)
+
+    found = {image_id: int(h) for image_id, h in zip(ids, hashes) if h}
+    add_hashes(found)
+    logger.success(f"Stored perceptual hashes for {len(found)} of {len(ids)} images.")
+
+    return len(found)
+
+def dedup_operation(use_hashes: bool = False) -> None:
+    """
+    Clusters the exported vectors (and optionally image hashes) and writes CLUSTER_PATH for the serving side.
+    """
+
+    with open(VECTOR_INDEX_PATH, "r", encoding="utf-8") as f:
+        records = json.load(f)
+
+    ids = [record["image_id"] for record in records]
+    vectors = np.array([record["vector"] for record in records], dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    logger.info(f"Loaded {len(ids)} vectors for duplicate clustering.")
+
+    hashes = load_hashes(ids) if use_hashes else None
+    clusters = cluster_duplicates(ids, vectors, hashes=hashes)
+
+    duplicates = sum(1 for image_id, cluster_id in clusters.items() if image_id != cluster_id)
+    logger.success(f"Found {len(set(clusters.values()))} unique memes; {duplicates} images are duplicates.")
+
+    makedirs(path.dirname(CLUSTER_PATH) or ".", exist_ok=True)
+    with open(CLUSTER_PATH, "w", encoding="utf-8") as f:
+        json.dump({str(k): v for k, v in clusters.items()}, f)
+
+    logger.success(f"Saved duplicate clusters to {CLUSTER_PATH}.")
+
+if __name__ == "__main__":
+    dedup_operation(use_hashes=True)
@@ -1,18 +1,28 @@
 from utils.encoder_gemini import generate_embedding_gemini
-from utils.schema import IndvVector
-from .dblite import get_memes, update_ready
+from utils.schema import IndvVector, ImageTrivial
+from utils.snapshot import publish_snapshot, write_atomic
+from utils.vindex import LocalVectorIndex, write_rescore_matrix
+from utils.indexfile import write_index_file
+from utils.captions import compact_from_full
+from .dblite import get_memes, update_ready, get_serving_captions
 from google.cloud import firestore
 from google.cloud.firestore_v1.vector import Vector
 from loguru import logger
 from dotenv import load_dotenv
-from os import getenv
+from os import getenv, makedirs, path
 from typing import List, Dict, Any
+import json
 
 load_dotenv()
 
 COLLECTION_NAME = getenv("FIRESTORE_COLLECTION")
 DB_ID = "gdg-ku-meme4you-test"
 PROJECT_ID = getenv("GOOGLE_PROJECT_ID")
+# Local copy of the uploaded vectors, read by the serving side's local vector engine
+VECTOR_INDEX_PATH = getenv("VECTOR_INDEX_PATH", "index/vectors.json")
+# Every export is also published as a versioned snapshot here; the server hot-swaps to it
+INDEX_SNAPSHOT_DIR = getenv("INDEX_SNAPSHOT_DIR", "index/snapshots")
+INDEX_SNAPSHOT_KEEP = int(getenv("INDEX_SNAPSHOT_KEEP", "3"))
 
 def embed_rows() -> List[IndvVector]:
     """
@@ -100,9 +110,81 @@ def upload_firestore(embeddings: List[IndvVector]) -> List[int]:
         logger.error(f"Error during uploading vectors to Firestore: {e}")
         return processed_ids
 
+def fetch_firestore_vectors() -> Dict[int, List[float]]:
+    """
+    Every vector in the Firestore collection, keyed by image_id.
+    """
+    db = firestore.Client(project=PROJECT_ID, database=DB_ID)
+    vectors: Dict[int, List[float]] = {}
+    for doc in db.collection(COLLECTION_NAME).stream():
+        data = doc.to_dict()
+        if data.get("image_id") is not None and data.get("vector") is not None:
+            vectors[int(data["image_id"])] = list(data["vector"])
+
+    logger.info(f"Fetched {len(vectors)} vectors from Firestore collection {COLLECTION_NAME}.")
+    return vectors
+
+def export_vectors(embeddings: List[IndvVector], ids: List[int], out_path: str = VECTOR_INDEX_PATH) -> None:
+    """
+    Merges the uploaded vectors into the local JSON export, keyed by image_id,
+    and publishes the result as a new index snapshot: the JSON plus a memory-mappable
+    index file (vectors and captions) that serving workers map instead of parsing JSON.
+    The export also gets its float32 rescoring matrix (.f32.npy), which servers only ever map.
+
+    Without an export yet (first run), the merge starts from the whole Firestore collection:
+    servers prefer the export over Firestore, so a partial one would shrink the served corpus.
+    Nothing is written if the collection can't be read.
+    """
+
+    existing: Dict[int, List[float]] = {}
+    if path.exists(out_path):
+        with open(out_path, "r", encoding="utf-8") as f:
+            existing = {item["image_id"]: item["vector"] for item in json.load(f)}
+    else:
+        try:
+            existing = fetch_firestore_vectors()
+        except Exception as e:
+            logger.error(f"{out_path} does not exist and the Firestore collection could not be read ({e}); not exporting a partial corpus.")
+            return
+
+    uploaded = set(ids)
+    for item in embeddings:
+        if item.get("image_id") in uploaded:
+            existing[item["image_id"]] = item["vector"]
+
+    records = [{"image_id": k, "vector": v} for k, v in sorted(existing.items())]
+
+    makedirs(path.dirname(out_path) or ".", exist_ok=True)
+    write_atomic(out_path, json.dumps(records))
+    logger.success(f"Exported {len(existing)} vectors to {out_path}.")
+    if records:
+        write_rescore_matrix(path.splitext(out_path)[0] + ".f32.npy", LocalVectorIndex.from_records(records).matrix)
+
+    publish_snapshot(records, INDEX_SNAPSHOT_DIR, keep=INDEX_SNAPSHOT_KEEP, derive=write_serving_index)
+
+def write_serving_index(records: List[Dict[str, Any]], index_path: str) -> None:
+    """
+    Index file for a snapshot: its vectors plus the serving captions of those images from the prep DB.
+    """
+
+    index = LocalVectorIndex.from_records(records)
+    rows = get_serving_captions([int(image_id) for image_id in index.ids])
+    captions = {
+        image_id: ImageTrivial(
+            image_id=image_id,
+            caption=row["caption"],
+            rerank_caption=row["rerank_caption"] or compact_from_full(row["caption"]),
+            like_cnt=row["like_cnt"] or 0,
+            tags=row["tags"]
+        )
+        for image_id, row in rows.items()
+    }
+    write_index_file(index_path, index, captions)
+
 def embedder_operation() -> None:
 
     embeddings = embed_rows()
+    processed_ids = []
 
     if embeddings:
         processed_ids = upload_firestore(embeddings)
@@ -110,6 +192,7 @@ def embedder_operation() -> None:
         logger.warning("No embeddings to upload.")
 
     if processed_ids:
+        export_vectors(embeddings, processed_ids)
         update_ready(processed_ids)
     else:
         logger.warning("There are no processed_ids returned by upload_firestore.")
@@ -16,10 +16,15 @@ def init_db() -> None:
         height INTEGER NOT NULL,
         src_url TEXT,
         caption TEXT,
+        rerank_caption TEXT,
         cloud_url TEXT,
         status TEXT
     )
     """)
+    # Columns added after the first schema; existing local DBs get them here
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(Image)").fetchall()]
+    if "rerank_caption" not in columns:
+        cursor.execute("ALTER TABLE Image ADD COLUMN rerank_caption TEXT")
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS ImageTag (
         image_tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -28,6 +33,20 @@ def init_db() -> None:
         FOREIGN KEY (image_id) REFERENCES Image(image_id)
     )
     """)
+    # Perceptual (d)hash per image, split into four 16-bit bands for multi-index lookup
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ImageHash (
+        image_id INTEGER PRIMARY KEY,
+        dhash INTEGER NOT NULL,
+        b0 INTEGER NOT NULL,
+        b1 INTEGER NOT NULL,
+        b2 INTEGER NOT NULL,
+        b3 INTEGER NOT NULL,
+        FOREIGN KEY (image_id) REFERENCES Image(image_id)
+    )
+    """)
+    for band in range(4):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_imagehash_b{band} ON ImageHash (b{band})")
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS Tag (
         tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
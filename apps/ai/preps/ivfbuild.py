@@ -0,0 +1,33 @@
+from utils.vindex import LocalVectorIndex
+from utils.ivf import IVFIndex
+from loguru import logger
+from dotenv import load_dotenv
+from os import getenv, makedirs, path
+from typing import Optional
+
+load_dotenv()
+
+# Input vectors (embedder.py's local export) and the IVF index search.py's ivf engine loads
+VECTOR_INDEX_PATH = getenv("VECTOR_INDEX_PATH", "index/vectors.json")
+IVF_PATH = getenv("IVF_PATH", "index/ivf.npz")
+# Number of k-means lists; 4 * sqrt(n) if unset
+IVF_NLIST = getenv("IVF_NLIST")
+
+def ivf_build_operation(nlist: Optional[int] = None, iters: int = 20) -> None:
+    """
+    Trains the coarse quantizer on the exported vectors and writes IVF_PATH.
+    Re-run after every embedder run; the serving side ignores an index built for other vectors.
+    """
+
+    index = LocalVectorIndex.from_json(VECTOR_INDEX_PATH)
+
+    nlist = nlist or (int(IVF_NLIST) if IVF_NLIST else None)
+    ivf = IVFIndex.build(index, nlist=nlist, iters=iters)
+
+    makedirs(path.dirname(IVF_PATH) or ".", exist_ok=True)
+    ivf.save(IVF_PATH)
+
+    logger.success(f"Saved IVF index ({ivf.nlist} lists, index version {ivf.version}) to {IVF_PATH}.")
+
+if __name__ == "__main__":
+    ivf_build_operation()
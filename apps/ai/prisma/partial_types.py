@@ -0,0 +1,4 @@
+from prisma.models import Image
+
+# Projection for the serving path; get_meta only needs id, captions, the like_cnt prior and tags (for filtering)
+Image.create_partial("ImageCaption", include={"image_id", "caption", "rerank_caption", "like_cnt", "ImageTag"})
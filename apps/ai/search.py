@@ -1,58 +1,545 @@
 import asyncio
+import threading
+import numpy as np
 from google import genai
 from google.genai import types
 from google.cloud import firestore
-from google.cloud.firestore_v1.document import DocumentSnapshot
 from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
 from google.cloud.firestore_v1.vector import Vector
 from dotenv import load_dotenv
 from loguru import logger
-from utils.encoder_gemini import generate_embedding_gemini
-from utils.dbhandler import get_meta
-from utils.gauth import get_client
-from utils.schema import ImageTrivial, GeminiResponse
-from typing import List, Optional, Tuple
-from os import getenv
+from prometheus_client import Counter, Histogram
+from utils.encoder_gemini import agenerate_embedding_gemini
+from utils.dbhandler import get_meta, caption_store, CAPTION_SOURCE
+from utils.captionstore import build_lexical
+from utils.lexindex import LexicalIndex
+from utils.indexfile import open_index_file, MappedCaptions
+from utils.gauth import get_client, get_async_client
+from utils.vindex import LocalVectorIndex
+from utils.tagindex import TagBitmapIndex
+from utils.ivf import IVFIndex
+from utils.snapshot import current_snapshot
+from utils.qcache import QueryEmbeddingCache, normalize_query
+from utils.rcache import SemanticResultCache
+from utils.singleflight import SingleFlight
+from utils.metrics import DEFAULT_BUCKETS
+from utils.profiling import record_timing
+from utils.schema import ImageTrivial, GeminiResponse, RankedResponse, IndvMemeReturn, VectorHit
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from os import getenv, path
+import json
+import time
 
 load_dotenv()
 
-# Define clients & models
-firestore_client = get_client(database="gdg-ku-meme4you-test")
-gemini_client = genai.Client()
-firestore_collection = firestore_client.collection(getenv("FIRESTORE_COLLECTION"))
-
 # Config
 metadata_dir = "./" # Remnant from local prototype
 embedding_output = "meme_embeddings.json" # Remnant from local prototype
+# Vector search engine: "firestore" (find_nearest), "local" (in-process NumPy index) or "ivf" (ANN over the local index)
+VECTOR_ENGINE = getenv("VECTOR_ENGINE", "firestore")
+# JSON export of [{"image_id", "vector"}] for the local engine; pulled from Firestore once if missing
+VECTOR_INDEX_PATH = getenv("VECTOR_INDEX_PATH", "index/vectors.json")
+# Local index scan precision: float32 (exact), float16 or int8 (quantized, short list of RESCORE_MULT x k rescored in float32).
+# Quantized indexes map the float32 rows from the .f32.npy embedder.py exports next to VECTOR_INDEX_PATH
+# (kept in memory if there is none); measured slower than float32 at this corpus size, so off by default
+VECTOR_PRECISION = getenv("VECTOR_PRECISION", "float32")
+RESCORE_MULT = int(getenv("RESCORE_MULT", "4"))
+# Matryoshka first pass: scan only the first VECTOR_COARSE_DIM dims (re-normalized, e.g. 256 of 768), then rescore the short list at full dim (empty: off)
+VECTOR_COARSE_DIM = int(getenv("VECTOR_COARSE_DIM") or 0) or None
+# Versioned snapshots published by embedder.py (CURRENT names the live one), and how often the server checks for a new one (0: never)
+INDEX_SNAPSHOT_DIR = getenv("INDEX_SNAPSHOT_DIR", "index/snapshots")
+INDEX_RELOAD_SEC = float(getenv("INDEX_RELOAD_SEC", "10"))
+# IVF index built offline by preps/ivfbuild.py, and the default number of lists probed per query
+IVF_PATH = getenv("IVF_PATH", "index/ivf.npz")
+IVF_NPROBE = int(getenv("IVF_NPROBE", "8"))
+# image_id -> duplicate cluster id, precomputed by preps/dedup.py; duplicates are collapsed before the rerank
+CLUSTER_PATH = getenv("CLUSTER_PATH", "index/clusters.json")
+# Query embedding cache; QUERY_CACHE_PATH (SQLite file) is optional and keeps entries across restarts
+QUERY_CACHE_SIZE = int(getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL = float(getenv("QUERY_CACHE_TTL", "86400"))
+QUERY_CACHE_PATH = getenv("QUERY_CACHE_PATH")
+# Semantic result cache; a query within RESULT_CACHE_THRESHOLD cosine of a cached one reuses its reranked result
+RESULT_CACHE_THRESHOLD = float(getenv("RESULT_CACHE_THRESHOLD", "0.95"))
+RESULT_CACHE_SIZE = int(getenv("RESULT_CACHE_SIZE", "512"))
+RESULT_CACHE_TTL = float(getenv("RESULT_CACHE_TTL", "3600"))
+# Corpus version tag for the Firestore engine; bump it after uploading new vectors (the local engine hashes its vectors)
+INDEX_VERSION = getenv("INDEX_VERSION", "firestore")
+# Latency budget (seconds) for the whole pipeline; the Gemini rerank gets whatever is left of it
+REQUEST_BUDGET_SEC = float(getenv("REQUEST_BUDGET_SEC", "5.0"))
+# Local fallback ranking: weight of the log(1 + like_cnt) prior, and cosine above which two candidates count as duplicates
+LIKE_PRIOR_WEIGHT = float(getenv("LIKE_PRIOR_WEIGHT", "0.01"))
+DUPLICATE_THRESHOLD = float(getenv("DUPLICATE_THRESHOLD", "0.97"))
+# Adaptive candidate depth: between MIN and MAX x count candidates go to the rerank,
+# cut at the largest score drop if it is at least CANDIDATE_MIN_GAP, otherwise at MAX
+CANDIDATE_MIN_MULT = float(getenv("CANDIDATE_MIN_MULT", "2"))
+CANDIDATE_MAX_MULT = float(getenv("CANDIDATE_MAX_MULT", "6"))
+CANDIDATE_MIN_GAP = float(getenv("CANDIDATE_MIN_GAP", "0.02"))
+# Tag filters always run on the local index, so with TAG_FILTERS on, the firestore engine also loads (and reloads) it at startup;
+# off, filtered requests are rejected under VECTOR_ENGINE=firestore instead
+TAG_FILTERS = getenv("TAG_FILTERS", "true").lower() == "true"
+# Hybrid retrieval: OCR n-gram matches covering at least LEXICAL_MIN_COVERAGE of the query
+# are fused with the vector hits by reciprocal rank fusion (constant RRF_K);
+# queries with fewer than LEXICAL_MIN_GRAMS distinct bigrams skip the lexical side
+HYBRID_SEARCH = getenv("HYBRID_SEARCH", "true").lower() == "true"
+LEXICAL_MIN_COVERAGE = float(getenv("LEXICAL_MIN_COVERAGE", "0.6"))
+LEXICAL_MIN_GRAMS = int(getenv("LEXICAL_MIN_GRAMS", "4"))
+RRF_K = int(getenv("RRF_K", "60"))
 
-# Function for firebase vector search
-def vsearch_fs(user_input: str, k: int = 5) -> List[DocumentSnapshot]:
+# Define clients & models
+gemini_client = genai.Client()
+_firestore_collection = None
+_firestore_async_collection = None
+_local_index: Optional[LocalVectorIndex] = None
+_clusters: Optional[Dict[int, int]] = None
+_tag_index: Optional[TagBitmapIndex] = None
+_ivf_index: Optional[IVFIndex] = None
+_ivf_source: Optional[LocalVectorIndex] = None # local index _ivf_index was last loaded for
+_index_key: Optional[str] = None # index_source() key of the loaded snapshot
+_reload_lock = asyncio.Lock()
+# Serializes the first local index load: concurrent first callers (threads) wait for one load instead of each pulling the corpus
+_load_lock = threading.Lock()
+query_cache = QueryEmbeddingCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, db_path=QUERY_CACHE_PATH)
+result_cache = SemanticResultCache(threshold=RESULT_CACHE_THRESHOLD, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+inflight = SingleFlight()
 
-    ret = []
+# Metrics, exposed on /metrics
+STAGE_SECONDS = Histogram("m4y_stage_seconds", "Wall time of each final_eval stage.", ["stage"], buckets=DEFAULT_BUCKETS)
+STAGE_ERRORS = Counter("m4y_stage_errors", "Stages that raised.", ["stage"])
+CANDIDATES = Histogram("m4y_candidates", "Rerank candidates per query.", buckets=(1, 2, 5, 10, 15, 20, 30, 50, 100))
+PROMPT_TOKENS = Histogram("m4y_prompt_tokens", "Gemini rerank prompt size in tokens.", buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+DEGRADED = Counter("m4y_degraded", "Responses ranked locally instead of by Gemini.", ["reason"])
+CACHE_REQUESTS = Counter("m4y_cache_requests", "Cache lookups by outcome.", ["cache", "result"])
+
+def count_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Times one pipeline stage into m4y_stage_seconds (and the request's Server-Timing, if tracked),
+    counting it in m4y_stage_errors_total if it raises.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage=name).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        record_timing(name, elapsed)
+
+def get_firestore_collection() -> firestore.CollectionReference:
+    """
+    Lazily connects to Firestore, so the local engine never needs Firestore credentials on the request path.
+    """
+    global _firestore_collection
+
+    if _firestore_collection is None:
+        firestore_client = get_client(database="gdg-ku-meme4you-test")
+        _firestore_collection = firestore_client.collection(getenv("FIRESTORE_COLLECTION"))
+
+    return _firestore_collection
+
+def get_firestore_async_collection() -> firestore.AsyncCollectionReference:
+    """
+    Async counterpart of get_firestore_collection, used on the request path.
+    """
+    global _firestore_async_collection
+
+    if _firestore_async_collection is None:
+        firestore_client = get_async_client(database="gdg-ku-meme4you-test")
+        _firestore_async_collection = firestore_client.collection(getenv("FIRESTORE_COLLECTION"))
+
+    return _firestore_async_collection
+
+def index_source() -> Tuple[Optional[str], str]:
+    """
+    (path, change key) of the vectors the local index should serve: the live snapshot in INDEX_SNAPSHOT_DIR,
+    else VECTOR_INDEX_PATH, else (None, "firestore") to pull from Firestore.
+    The key also covers the IVF and cluster files, which are rebuilt offline alongside the vectors.
+    """
+    source = current_snapshot(INDEX_SNAPSHOT_DIR) or (VECTOR_INDEX_PATH if path.exists(VECTOR_INDEX_PATH) else None)
+
+    parts = [f"{source}:{path.getmtime(source)}" if source else "firestore"]
+    for extra in (IVF_PATH, CLUSTER_PATH):
+        if path.exists(extra):
+            parts.append(f"{extra}:{path.getmtime(extra)}")
+
+    return source, "|".join(parts)
+
+def load_local_index(source: Optional[str]) -> Tuple[LocalVectorIndex, Optional[MappedCaptions]]:
+    """
+    Maps the snapshot's index file if it has one (shared by all workers, nothing parsed),
+    otherwise loads its JSON, VECTOR_INDEX_PATH's JSON, or pulls from Firestore.
+    """
+    index_file = path.splitext(source)[0] + ".idx" if source else None
+    if index_file and path.exists(index_file):
+        return open_index_file(index_file, precision=VECTOR_PRECISION, rescore_mult=RESCORE_MULT, coarse_dim=VECTOR_COARSE_DIM)
+
+    options = {
+        "precision": VECTOR_PRECISION,
+        "rescore_mult": RESCORE_MULT,
+        "rescore_path": path.splitext(source)[0] + ".f32.npy" if source and (VECTOR_PRECISION != "float32" or VECTOR_COARSE_DIM) else None,
+        "coarse_dim": VECTOR_COARSE_DIM,
+    }
+    if source:
+        return LocalVectorIndex.from_json(source, **options), None
+
+    logger.warning(f"{VECTOR_INDEX_PATH} not found. Building local index from Firestore...")
+    return LocalVectorIndex.from_firestore(get_firestore_collection(), **options), None
+
+def prepare_captions(captions: Optional[MappedCaptions]) -> Optional[Tuple[MappedCaptions, LexicalIndex]]:
+    """
+    (source, lexical index) to attach to the caption store when captions come from the index file.
+    The lexical index maps the file's postings; only files written before they existed are decoded and indexed here.
+    """
+    if CAPTION_SOURCE != "index" or captions is None:
+        return None
+
+    lexical = captions.lexical()
+    return captions, lexical if lexical is not None else build_lexical(captions.items())
+
+def get_local_index() -> LocalVectorIndex:
+    """
+    Loads the in-process vector index once; reload_index swaps in newer snapshots afterwards.
+    """
+    global _local_index, _index_key
+
+    if _local_index is None:
+        with _load_lock:
+            if _local_index is None:
+                source, key = index_source()
+                index, captions = load_local_index(source)
+                attachment = prepare_captions(captions)
+                if attachment:
+                    caption_store.attach(*attachment)
+                _local_index = index
+                _index_key = key
+
+    return _local_index
+
+def local_index_in_use() -> bool:
+    """
+    Whether this server serves from the local index at all: as its engine, as its caption source, or for tag filters.
+    Such servers load it at startup and follow new snapshots.
+    """
+    return VECTOR_ENGINE in ("local", "ivf") or CAPTION_SOURCE == "index" or TAG_FILTERS
+
+def tag_filters_available() -> bool:
+    return VECTOR_ENGINE in ("local", "ivf") or TAG_FILTERS
+
+def load_ivf_index(index: LocalVectorIndex) -> Optional[IVFIndex]:
+
+    if path.exists(IVF_PATH):
+        return IVFIndex.load(IVF_PATH, index, nprobe=IVF_NPROBE)
+
+    logger.warning(f"{IVF_PATH} not found. The ivf engine falls back to exact search; run preps/ivfbuild.py.")
+    return None
+
+def get_ivf_index() -> Optional[IVFIndex]:
+    """
+    Loads the IVF index for the current local index once; None (exact search) if it is missing or stale.
+    """
+    global _ivf_index, _ivf_source
 
-    # Embed the user's query using the 'retrieval_query' task type for optimal search performance
-    user_input_embedding = generate_embedding_gemini(
-        texts=[user_input], task_type="RETRIEVAL_QUERY"
-    )[0]
+    index = get_local_index()
+    if _ivf_source is not index:
+        _ivf_index = load_ivf_index(index)
+        _ivf_source = index
 
-    logger.info("Embedding acquired. Now performing vector search...")
+    return _ivf_index
 
-    results = firestore_collection.find_nearest(
+def load_clusters() -> Dict[int, int]:
+
+    if not path.exists(CLUSTER_PATH):
+        logger.warning(f"{CLUSTER_PATH} not found. Duplicate candidates will not be collapsed.")
+        return {}
+
+    with open(CLUSTER_PATH, "r", encoding="utf-8") as f:
+        clusters = {int(k): v for k, v in json.load(f).items()}
+    logger.info(f"Loaded {len(clusters)} duplicate cluster assignments from {CLUSTER_PATH}.")
+
+    return clusters
+
+def get_clusters() -> Dict[int, int]:
+    """
+    Loads the duplicate cluster map once; without one every image is its own cluster.
+    """
+    global _clusters
+
+    if _clusters is None:
+        _clusters = load_clusters()
+
+    return _clusters
+
+async def reload_index(force: bool = False) -> bool:
+    """
+    Loads the current snapshot (plus IVF and cluster files) off the event loop if it changed, then swaps it in.
+    The swap is a handful of plain assignments with no await in between, so every request sees
+    either the old set or the new one; requests already running keep the objects they hold.
+    Results cached against the old version are dropped. Returns whether it swapped.
+    """
+    global _local_index, _index_key, _ivf_index, _ivf_source, _clusters
+
+    async with _reload_lock:
+        source, key = await asyncio.to_thread(index_source)
+        if key == _index_key and not force:
+            return False
+
+        index, captions = await asyncio.to_thread(load_local_index, source)
+        attachment = await asyncio.to_thread(prepare_captions, captions)
+        ivf = await asyncio.to_thread(load_ivf_index, index) if VECTOR_ENGINE == "ivf" else None
+        clusters = await asyncio.to_thread(load_clusters)
+
+        old_version = _local_index.version if _local_index is not None else None
+        _local_index, _index_key, _clusters = index, key, clusters
+        _ivf_index, _ivf_source = ivf, (index if VECTOR_ENGINE == "ivf" else None)
+        if attachment:
+            caption_store.attach(*attachment)
+        if old_version is not None and old_version != index.version:
+            result_cache.invalidate(old_version)
+
+        logger.success(f"Swapped in index version {index.version} ({len(index)} vectors, was {old_version}).")
+        return True
+
+async def watch_index(interval: float = INDEX_RELOAD_SEC) -> None:
+    """
+    Background task: picks up new snapshots as soon as the pipeline publishes them.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reload_index()
+        except Exception as e:
+            logger.error(f"Index reload failed: {e}")
+
+def get_tag_index() -> TagBitmapIndex:
+    """
+    Per-tag bitsets over the local index rows, rebuilt when the index or the caption store (the tag source) changes.
+    """
+    global _tag_index
+
+    index = get_local_index()
+    version = f"{index.version}:{caption_store.revision}"
+    if _tag_index is None or _tag_index.version != version:
+        _tag_index = TagBitmapIndex(index.ids, caption_store.tags(), version=version, base=caption_store.tag_rows())
+
+    return _tag_index
+
+def tag_mask(include_tags: Optional[List[str]], exclude_tags: Optional[List[str]]) -> Optional[np.ndarray]:
+    """
+    Local index row mask for a tag filter, or None when there is no filter.
+    """
+    if not include_tags and not exclude_tags:
+        return None
+
+    return get_tag_index().mask(include_tags or [], exclude_tags or [])
+
+def tag_scope(include_tags: Optional[List[str]], exclude_tags: Optional[List[str]]) -> str:
+    """
+    Canonical form of a tag filter, for cache and in-flight keys; "" when there is no filter.
+    """
+    return ",".join(
+        [f"+{tag}" for tag in sorted(set(include_tags or []))] + [f"-{tag}" for tag in sorted(set(exclude_tags or []))]
+    )
+
+def result_scope(engine: str, nprobe: Optional[int], scope: str) -> str:
+    """
+    Result cache scope: the tag filter scope plus the search that produced the candidates
+    (engine, and for ivf the lists probed), so a shallow probe never answers for a deeper one.
+    """
+    search = f"ivf:{nprobe or IVF_NPROBE}" if engine == "ivf" else engine
+
+    return f"{search}|{scope}"
+
+def collapse_duplicates(hits: List[VectorHit]) -> List[VectorHit]:
+    """
+    Keeps only the best-scoring hit of each duplicate cluster, preserving order.
+    """
+    clusters = get_clusters()
+    seen = set()
+    unique = []
+
+    for hit in hits:
+        cluster_id = clusters.get(hit.image_id, hit.image_id)
+        if cluster_id not in seen:
+            seen.add(cluster_id)
+            unique.append(hit)
+
+    return unique
+
+def index_version(engine: str = VECTOR_ENGINE) -> str:
+    """
+    Version tag of the corpus the given engine searches.
+    """
+    if engine in ("local", "ivf") and _local_index is not None:
+        return _local_index.version
+
+    return INDEX_VERSION
+
+# Function to embed user queries, all cache misses in one Gemini call
+async def embed_queries(user_inputs: List[str]) -> List[List[float]]:
+
+    # Repeated or near-identical phrasings share one cached embedding: the normalized form is only the cache key,
+    # the model sees the text as the user wrote it (first phrasing of each key)
+    keys = [normalize_query(user_input) for user_input in user_inputs]
+    texts: Dict[str, str] = {}
+    for key, user_input in zip(keys, user_inputs):
+        texts.setdefault(key, user_input)
+    vectors = {key: await query_cache.get(key) for key in texts}
+    for vector in vectors.values():
+        count_lookup("query", vector is not None)
+    missing = [key for key, vector in vectors.items() if vector is None]
+
+    if missing:
+        # Embed the raw queries using the 'retrieval_query' task type for optimal search performance
+        embeddings = await agenerate_embedding_gemini(
+            texts=[texts[key] for key in missing], task_type="RETRIEVAL_QUERY"
+        )
+        if len(embeddings) != len(missing):
+            raise RuntimeError("Failed to embed the user's query.")
+
+        for key, vector in zip(missing, embeddings):
+            query_cache.put(key, vector)
+            vectors[key] = vector
+    else:
+        logger.debug(f"Query embedding cache hit: {keys}")
+
+    return [vectors[key] for key in keys]
+
+# Function to embed the user's query
+async def embed_query(user_input: str) -> List[float]:
+
+    return (await embed_queries([user_input]))[0]
+
+# Function for firebase vector search
+async def vsearch_fs(query_vector: List[float], k: int = 5) -> List[VectorHit]:
+
+    ret = []
+
+    results = get_firestore_async_collection().find_nearest(
         vector_field="vector",
-        query_vector=Vector(user_input_embedding),
+        query_vector=Vector(query_vector),
         distance_measure=DistanceMeasure.COSINE,
-        limit=k
+        limit=k,
+        distance_result_field="vector_distance"
     )
 
-    if results:
-        logger.success("Vector search complete.")
-
-    for result in results.stream():
-        ret.append(result)
+    async for result in results.stream():
+        data = result.to_dict()
+        if 'image_id' in data:
+            # Cosine distance is 1 - cosine similarity
+            ret.append(VectorHit(image_id=data['image_id'], score=1.0 - data.get('vector_distance', 1.0)))
     #logger.debug(f"Vector search results: {ret}")
 
     return ret
 
+# Function for in-process vector search
+async def vsearch_local(query_vector: List[float], k: int = 5, mask: Optional[np.ndarray] = None) -> List[VectorHit]:
+
+    # First use loads the index off the event loop; the search itself is a sub-millisecond matmul
+    index = _local_index or await asyncio.to_thread(get_local_index)
+
+    return index.search(query_vector, k, mask=mask)
+
+# Function for approximate in-process vector search
+async def vsearch_ivf(query_vector: List[float], k: int = 5, nprobe: Optional[int] = None) -> List[VectorHit]:
+
+    loaded = _local_index is not None and _ivf_source is _local_index
+    ivf = _ivf_index if loaded else await asyncio.to_thread(get_ivf_index)
+    if ivf is None:
+        return await vsearch_local(query_vector, k)
+
+    return ivf.search(query_vector, k, nprobe=nprobe)
+
+VECTOR_ENGINES = {
+    "firestore": vsearch_fs,
+    "local": vsearch_local,
+    "ivf": vsearch_ivf,
+}
+
+# Function for vector search with the configured engine
+async def vsearch(query_vector: List[float], k: int = 5, engine: str = VECTOR_ENGINE, mask: Optional[np.ndarray] = None, nprobe: Optional[int] = None) -> List[VectorHit]:
+
+    if engine not in VECTOR_ENGINES:
+        raise ValueError(f"Invalid vector engine '{engine}'. Must be one of {list(VECTOR_ENGINES)}")
+    if mask is not None and engine != "local":
+        raise ValueError("Tag filters need the local engine; Firestore vector documents carry no tags.")
+
+    logger.info(f"Performing vector search ({engine})...")
+
+    if mask is not None:
+        ret = await vsearch_local(query_vector, k, mask=mask)
+    elif engine == "ivf":
+        ret = await vsearch_ivf(query_vector, k, nprobe=nprobe)
+    else:
+        ret = await VECTOR_ENGINES[engine](query_vector, k)
+
+    if ret:
+        logger.success("Vector search complete.")
+
+    return ret
+
+# Function for vector search over several queries at once
+async def vsearch_batch(query_vectors: List[List[float]], k: int = 5, engine: str = VECTOR_ENGINE, mask: Optional[np.ndarray] = None, nprobe: Optional[int] = None) -> List[List[VectorHit]]:
+
+    # The local index answers every query with a single matmul
+    if engine == "local":
+        index = _local_index or await asyncio.to_thread(get_local_index)
+        return index.search_batch(query_vectors, k, mask=mask)
+
+    return list(await asyncio.gather(*(vsearch(query_vector, k, engine, mask, nprobe) for query_vector in query_vectors)))
+
+# Function for lexical search over the captions' OCR text
+def lexical_search(user_input: str, k: int) -> List[VectorHit]:
+
+    return caption_store.lexical.search(user_input, k, min_coverage=LEXICAL_MIN_COVERAGE, min_grams=LEXICAL_MIN_GRAMS)
+
+def rrf_fuse(hit_lists: List[List[VectorHit]], rrf_k: int = RRF_K) -> List[VectorHit]:
+    """
+    Reciprocal rank fusion: each list adds 1 / (rrf_k + rank) to an image's score.
+    Scores are divided by the best possible total, so they stay in 0..1 like cosine scores.
+    """
+    scores: Dict[int, float] = {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit.image_id] = scores.get(hit.image_id, 0.0) + 1.0 / (rrf_k + rank)
+
+    best = len(hit_lists) / (rrf_k + 1)
+    fused = [VectorHit(image_id=image_id, score=score / best) for image_id, score in scores.items()]
+    fused.sort(key=lambda hit: -hit.score)
+
+    return fused
+
+def select_candidates(user_input: str, hits: List[VectorHit], final_cnt: int, k: Optional[int] = None, mask: Optional[np.ndarray] = None) -> List[VectorHit]:
+    """
+    Turns raw vector hits into the rerank candidates: duplicates collapsed, depth chosen on the
+    cosine scores (or fixed at k), and lexical OCR matches fused in by RRF when there are any.
+    Lexical matches outside the tag filter's mask are dropped like the vector search drops them.
+
+    RRF only decides the order: the returned hits keep their cosine scores, which local_rank reads.
+    Lexical-only hits have none and get the weakest vector score, so the fallback ranks them last.
+    """
+    hits = collapse_duplicates(hits)
+    depth = k or select_depth(hits, final_cnt)
+
+    lexical = lexical_search(user_input, k or max_depth(final_cnt)) if HYBRID_SEARCH else []
+    if lexical and mask is not None:
+        rows = get_local_index().rows_of(hit.image_id for hit in lexical)
+        lexical = [hit for hit, row in zip(lexical, rows) if row >= 0 and mask[row]]
+    if lexical:
+        logger.debug(f"Lexical matches: {[hit.image_id for hit in lexical]}")
+        cosine = {hit.image_id: hit.score for hit in hits}
+        floor = min(cosine.values(), default=0.0)
+        fused = rrf_fuse([hits, lexical])
+        hits = collapse_duplicates([VectorHit(image_id=hit.image_id, score=cosine.get(hit.image_id, floor)) for hit in fused])
+
+    return hits[:depth]
+
 # Function to return the prompt for final Gemini selection
 def get_prompt(cnt: int, user_input: str, images: List[ImageTrivial]) -> Tuple[str, str, str]:
 
@@ -62,8 +549,6 @@ def get_prompt(cnt: int, user_input: str, images: List[ImageTrivial]) -> Tuple[s
 제시된 후보 밈 중에서, 이용자의 **상황 및 맥락**에 가장 일치하는 밈 상위 {cnt}개를 선정해.
 선정한 {cnt}개의 밈을 가장 적절한 순서대로 아래 JSON 형식으로 반환해.
 
-만약 제시된 후보 중 동일한 이미지인 것이 의심될 정도로 메타데이터가 유사한 후보들이 있는 경우, 중복 선정하지 말고 그 중 하나만 처리하고 나머지는 제외해.
-
 {{"text": [
     {{"image_id": <id of the best fitting meme image>}},
     {{"image_id": <id of the second best fitting meme image>}},
@@ -77,9 +562,9 @@ def get_prompt(cnt: int, user_input: str, images: List[ImageTrivial]) -> Tuple[s
     # Format the candidate images into a string for the user prompt
     candidates_list = []
     for img in images:
-        # Using a simple, readable format for the model
+        # Using a simple, readable format for the model; the compact caption keeps the prompt short
         candidates_list.append(
-            f"후보 밈:\n- ID: {img.image_id}\n- 설명: {img.caption}\n"
+            f"후보 밈:\n- ID: {img.image_id}\n- 설명: {img.rerank_caption or img.caption}\n"
         )
     
     candidates_str = "---\n" + "\n".join(candidates_list)
@@ -87,7 +572,7 @@ def get_prompt(cnt: int, user_input: str, images: List[ImageTrivial]) -> Tuple[s
     return sys_prompt, user_input, candidates_str
 
 # Function for final evaluation request to Gemini
-def gemini_call(sys_prompt: str, user_input: str, user_prompt: str) -> Optional[GeminiResponse]:
+async def gemini_call(sys_prompt: str, user_input: str, user_prompt: str) -> Optional[GeminiResponse]:
     """
     Makes a structured content generation call to the Gemini API.
     """
@@ -99,11 +584,14 @@ def gemini_call(sys_prompt: str, user_input: str, user_prompt: str) -> Optional[
     )
 
     try:
-        response = gemini_client.models.generate_content(
+        response = await gemini_client.aio.models.generate_content(
             model="gemini-2.5-flash",
             contents=[user_input, user_prompt],
             config=config
         )
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None and usage.prompt_token_count:
+            PROMPT_TOKENS.observe(usage.prompt_token_count)
         # The response.text is a JSON string. We need to parse it into our Pydantic model.
         if response.text:
             parsed_response = GeminiResponse.model_validate_json(response.text)
@@ -115,40 +603,271 @@ def gemini_call(sys_prompt: str, user_input: str, user_prompt: str) -> Optional[
         logger.error(f"Gemini API call failed: {e}")
         return None
 
-# Overall rec pipeline
-async def final_eval(user_input: str, k: int = 20, final_cnt: int = 5) -> Optional[GeminiResponse]:
+# Function to decide how many candidates the rerank gets
+def max_depth(final_cnt: int) -> int:
+    return max(final_cnt, int(np.ceil(CANDIDATE_MAX_MULT * final_cnt)))
+
+def select_depth(hits: List[VectorHit], final_cnt: int) -> int:
+    """
+    Knee detection on the (descending) cosine scores.
+    A clear winner group ends with a large drop, so the list is cut right after it;
+    a flat distribution has no such drop and keeps the maximum depth.
+    """
+    lo = min(len(hits), max(final_cnt, int(np.ceil(CANDIDATE_MIN_MULT * final_cnt))))
+    hi = min(len(hits), max_depth(final_cnt))
+    if hi <= lo:
+        return hi
+
+    scores = np.array([hit.score for hit in hits[:hi]], dtype=np.float32)
+    # gaps[j] is the drop right after keeping lo + j candidates
+    gaps = scores[lo - 1:hi - 1] - scores[lo:hi]
+    best = int(np.argmax(gaps))
+
+    if gaps[best] >= CANDIDATE_MIN_GAP:
+        return lo + best
+
+    return hi
+
+# Function for local fallback ranking when the Gemini rerank is unavailable
+def local_rank(hits: List[VectorHit], images: List[ImageTrivial], cnt: int, engine: str = VECTOR_ENGINE) -> List[IndvMemeReturn]:
+    """
+    Ranks candidates by vector score plus a like_cnt prior, dropping near-duplicates:
+    same caption, or (local engine only) stored vectors closer than DUPLICATE_THRESHOLD.
+    """
+
+    images_by_id = {img.image_id: img for img in images}
+    candidates = [hit for hit in hits if hit.image_id in images_by_id]
+    candidates.sort(
+        key=lambda hit: hit.score + LIKE_PRIOR_WEIGHT * np.log1p(images_by_id[hit.image_id].like_cnt),
+        reverse=True
+    )
+
+    vectors = None
+    if engine in ("local", "ivf") and _local_index is not None:
+        vectors = _local_index.get_vectors([hit.image_id for hit in candidates])
+
+    picked: List[int] = []
+    seen_captions = set()
+    for i, hit in enumerate(candidates):
+        caption = images_by_id[hit.image_id].caption.strip()
+        if caption in seen_captions:
+            continue
+        if vectors is not None and picked and np.max(vectors[picked] @ vectors[i]) >= DUPLICATE_THRESHOLD:
+            continue
+
+        picked.append(i)
+        seen_captions.add(caption)
+        if len(picked) == cnt:
+            break
+
+    return [IndvMemeReturn(image_id=candidates[i].image_id, rank=rank) for rank, i in enumerate(picked, start=1)]
+
+# Function for the final ranking of one query's candidates
+async def rank_candidates(user_input: str, hits: List[VectorHit], candidate_images: List[ImageTrivial], final_cnt: int, engine: str, deadline: float) -> RankedResponse:
+    """
+    Calls Gemini for the final ranking, within what is left until `deadline` (event loop time).
+    If it times out or fails, falls back to local_rank and flags the response as degraded.
+    """
+    loop = asyncio.get_running_loop()
+
+    if not candidate_images:
+        logger.warning("No candidates to rank.")
+        return RankedResponse(text=[])
+
+    # Prepare prompts and call Gemini
+    with stage("prompt"):
+        sys_prompt, user_input_prompt, user_prompt = get_prompt(cnt=final_cnt, user_input=user_input, images=candidate_images)
+    logger.info("Prompt ready. Now calling Gemini...")
+    # A timeout, like a failed call (gemini_call returns None), is a degraded outcome rather than a stage error
+    reason = "error"
+    remaining = deadline - loop.time()
+    if remaining <= 0:
+        # Earlier stages used up the budget; don't start a call that is cancelled at once
+        logger.warning(f"The {REQUEST_BUDGET_SEC}s request budget was spent before the rerank.")
+        gemini_response = None
+        reason = "timeout"
+    else:
+        with stage("rerank"):
+            try:
+                gemini_response = await asyncio.wait_for(
+                    gemini_call(sys_prompt=sys_prompt, user_input=user_input_prompt, user_prompt=user_prompt),
+                    timeout=remaining
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Gemini rerank exceeded the {REQUEST_BUDGET_SEC}s request budget.")
+                gemini_response = None
+                reason = "timeout"
+
+    # Drop ids Gemini made up
+    if gemini_response is not None:
+        candidate_set = {img.image_id for img in candidate_images}
+        gemini_response.text = [ret for ret in gemini_response.text if ret.image_id in candidate_set]
+
+    if not gemini_response or not gemini_response.text:
+        logger.warning("Falling back to local ranking.")
+        DEGRADED.labels(reason=reason if gemini_response is None else "empty").inc()
+        return RankedResponse(text=local_rank(hits, candidate_images, final_cnt, engine), degraded=True)
+
+    return RankedResponse(text=gemini_response.text)
+
+# Overall rec pipeline, staged
+async def eval_stages(user_input: str, k: Optional[int] = None, final_cnt: int = 5, engine: Optional[str] = None, include_tags: Optional[List[str]] = None, exclude_tags: Optional[List[str]] = None, nprobe: Optional[int] = None) -> AsyncIterator[Tuple[str, RankedResponse]]:
     """
     user_input: user's natural language input
-    k: vector search candidate numbers
+    k: fixed vector search candidate number; adaptive (select_depth) if None
     final_cnt: number of final recommendations to return
+    engine: vector search engine, defaults to VECTOR_ENGINE; tag-filtered queries always use the local index
+    include_tags / exclude_tags: tag filter, applied before top-k through per-tag bitsets
+    nprobe: IVF lists probed (ivf engine only), defaults to IVF_NPROBE; higher is slower and more exact
+
+    Yields ("vector", top vector hits) as soon as vector search returns,
+    then ("final", reranked result). A semantic cache hit yields only "final".
 
     Orchestrates the final evaluation process:
-    1. Vector search for initial candidates.
-    2. Get metadata for candidates.
-    3. Call Gemini for final ranking.
+    1. Embed the query within REQUEST_BUDGET_SEC, and reuse a cached result for a near-identical query if there is one.
+    2. Vector search for initial candidates, fused with lexical OCR matches.
+    3. Get metadata for candidates.
+    4. Call Gemini for final ranking, within what is left of REQUEST_BUDGET_SEC.
+       If it times out or fails, fall back to local_rank and flag the response as degraded.
     """
-    # Set initial candidates search number
-    k = 4 * final_cnt
+    engine = "local" if include_tags or exclude_tags else (engine or VECTOR_ENGINE)
+    deadline = asyncio.get_running_loop().time() + REQUEST_BUDGET_SEC
+    scope = tag_scope(include_tags, exclude_tags)
+
+    # Embed the query and check the semantic result cache; embed retries count against the budget too,
+    # and there is no fallback without a vector, so running out here fails the request (asyncio.TimeoutError)
+    with stage("embed"):
+        query_vector = await asyncio.wait_for(embed_query(user_input), timeout=max(deadline - asyncio.get_running_loop().time(), 0.0))
+    logger.info("Embedding acquired.")
+
+    mask = None
+    if scope:
+        # Tag bitsets are indexed by local index rows; load it off the event loop on first use
+        if _local_index is None:
+            await asyncio.to_thread(get_local_index)
+        mask = tag_mask(include_tags, exclude_tags)
+        logger.info(f"Tag filter {scope} matches {int(np.count_nonzero(mask))} images.")
 
-    # Get initial candidates from Firestore vector search
-    vsearch_results = vsearch_fs(user_input=user_input, k=k)
-    candidate_ids = [res.to_dict()['image_id'] for res in vsearch_results if 'image_id' in res.to_dict()]
-    logger.info("Vector search complete.")
+    cached = result_cache.lookup(query_vector, final_cnt, index_version(engine), result_scope(engine, nprobe, scope))
+    count_lookup("result", cached is not None)
+    if cached is not None:
+        logger.success("Final evaluation served from semantic result cache.")
+        yield "final", cached
+        return
+
+    # Get initial candidates from vector search
+    with stage("vector_search"):
+        vsearch_results = await vsearch(query_vector=query_vector, k=k or max_depth(final_cnt), engine=engine, mask=mask, nprobe=nprobe)
+        vsearch_results = select_candidates(user_input, vsearch_results, final_cnt, k, mask)
+    candidate_ids = [hit.image_id for hit in vsearch_results]
+    CANDIDATES.observe(len(candidate_ids))
+    logger.info(f"Vector search complete. {len(candidate_ids)} candidates.")
     logger.debug(f"Candidate IDs: {candidate_ids}")
 
+    # Preliminary result: raw vector search order
+    yield "vector", RankedResponse(
+        text=[IndvMemeReturn(image_id=hit.image_id, rank=rank) for rank, hit in enumerate(vsearch_results[:final_cnt], start=1)]
+    )
+
     # Get metadata (captions) for the candidates
-    # Note: get_meta is an async function, but we'll call it synchronously for simplicity here.
-    # In a real FastAPI app, this should be handled with `await`.
-    candidate_images = await get_meta(candidate_ids)
+    with stage("metadata"):
+        candidate_images = await get_meta(candidate_ids)
     logger.info("Metadata retrieval for candidates complete.")
 
-    # Prepare prompts and call Gemini
-    sys_prompt, user_input_prompt, user_prompt = get_prompt(cnt=final_cnt, user_input=user_input, images=candidate_images)
-    logger.info("Prompt ready. Now calling Gemini...")
-    gemini_response = gemini_call(sys_prompt=sys_prompt, user_input=user_input_prompt, user_prompt=user_prompt)
+    ranked = await rank_candidates(user_input, vsearch_results, candidate_images, final_cnt, engine, deadline)
     logger.success("Final evaluation complete.")
-    
-    return gemini_response
+
+    if ranked.text and not ranked.degraded:
+        result_cache.store(query_vector, final_cnt, index_version(engine), ranked, result_scope(engine, nprobe, scope))
+
+    yield "final", ranked
+
+# Overall rec pipeline
+async def final_eval(user_input: str, k: Optional[int] = None, final_cnt: int = 5, engine: Optional[str] = None, include_tags: Optional[List[str]] = None, exclude_tags: Optional[List[str]] = None, nprobe: Optional[int] = None) -> RankedResponse:
+    """
+    Runs eval_stages to completion and returns only the final result.
+    Concurrent requests with the same normalized text, count and tag filter share one computation.
+    """
+    engine = engine or VECTOR_ENGINE
+
+    async def run() -> RankedResponse:
+        result = RankedResponse(text=[])
+        async for _, result in eval_stages(user_input=user_input, k=k, final_cnt=final_cnt, engine=engine, include_tags=include_tags, exclude_tags=exclude_tags, nprobe=nprobe):
+            pass
+        return result
+
+    key = (normalize_query(user_input), k, final_cnt, engine, tag_scope(include_tags, exclude_tags), nprobe)
+    count_lookup("inflight", key in inflight)
+
+    return await inflight.do(key, run)
+
+# Rec pipeline for many queries at once
+async def batch_eval(user_inputs: List[str], k: Optional[int] = None, final_cnt: int = 5, engine: Optional[str] = None, include_tags: Optional[List[str]] = None, exclude_tags: Optional[List[str]] = None, nprobe: Optional[int] = None) -> List[RankedResponse]:
+    """
+    Same as final_eval for each input, but with the shared work done once:
+    one embedding call for all cache misses, one vector search pass (a single matmul on the local engine),
+    and one metadata lookup over the union of candidates. Reranks run concurrently.
+    The tag filter, if any, applies to every input.
+    Inputs that normalize alike (normalize_query) are evaluated once and share the result, as in final_eval.
+    """
+    engine = "local" if include_tags or exclude_tags else (engine or VECTOR_ENGINE)
+    deadline = asyncio.get_running_loop().time() + REQUEST_BUDGET_SEC
+    scope = tag_scope(include_tags, exclude_tags)
+
+    # One slot per normalized query, holding its first phrasing; results are scattered back to input order at the end
+    keys = [normalize_query(user_input) for user_input in user_inputs]
+    slots: Dict[str, str] = {}
+    for key, user_input in zip(keys, user_inputs):
+        slots.setdefault(key, user_input)
+    texts = list(slots.values())
+
+    with stage("embed"):
+        query_vectors = await asyncio.wait_for(embed_queries(texts), timeout=max(deadline - asyncio.get_running_loop().time(), 0.0))
+    logger.info(f"Embeddings acquired for {len(texts)} distinct queries out of {len(user_inputs)}.")
+
+    mask = None
+    if scope:
+        if _local_index is None:
+            await asyncio.to_thread(get_local_index)
+        mask = tag_mask(include_tags, exclude_tags)
+
+    version, cache_scope = index_version(engine), result_scope(engine, nprobe, scope)
+    results: List[Optional[RankedResponse]] = [result_cache.lookup(vector, final_cnt, version, cache_scope) for vector in query_vectors]
+    for result in results:
+        count_lookup("result", result is not None)
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if pending:
+        with stage("vector_search"):
+            hit_lists = await vsearch_batch([query_vectors[i] for i in pending], k=k or max_depth(final_cnt), engine=engine, mask=mask, nprobe=nprobe)
+            hit_lists = [select_candidates(texts[i], hits, final_cnt, k, mask) for i, hits in zip(pending, hit_lists)]
+        for hits in hit_lists:
+            CANDIDATES.observe(len(hits))
+        logger.info("Batch vector search complete.")
+
+        all_ids = list(dict.fromkeys(hit.image_id for hits in hit_lists for hit in hits))
+        with stage("metadata"):
+            images_by_id = {img.image_id: img for img in await get_meta(all_ids)}
+        logger.info("Metadata retrieval for candidates complete.")
+
+        ranked = await asyncio.gather(*(
+            rank_candidates(
+                texts[i], hits,
+                [images_by_id[hit.image_id] for hit in hits if hit.image_id in images_by_id],
+                final_cnt, engine, deadline
+            )
+            for i, hits in zip(pending, hit_lists)
+        ))
+
+        for i, result in zip(pending, ranked):
+            results[i] = result
+            if result.text and not result.degraded:
+                result_cache.store(query_vectors[i], final_cnt, index_version(engine), result, cache_scope)
+
+    logger.success("Batch evaluation complete.")
+    slot_of = {key: n for n, key in enumerate(slots)}
+
+    return [results[slot_of[key]] for key in keys]
 
 # For testing
 if __name__ == "__main__":
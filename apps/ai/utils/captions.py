@@ -0,0 +1,80 @@
+import re
+from dotenv import load_dotenv
+from os import getenv
+from typing import Tuple
+
+load_dotenv()
+
+# Hard per-candidate budget for the compact caption pasted into the rerank prompt
+RERANK_TOKEN_BUDGET = int(getenv("RERANK_TOKEN_BUDGET", "64"))
+
+# Full captions are stored as "OCR: ..., Caption: ..., Humor: ..." (see captioner.caption_converter)
+_FULL_CAPTION = re.compile(r"^OCR:\s*(?P<ocr>.*?),\s*Caption:\s*(?P<caption>.*?),\s*Humor:\s*(?P<humor>.*)$", re.DOTALL)
+_SENTENCE_END = re.compile(r"(?<=[.!?다요])\s")
+_WHITESPACE = re.compile(r"\s+")
+
+def split_caption(full_caption: str) -> Tuple[str, str, str]:
+    """
+    Splits a stored full caption back into (ocr, caption, humor).
+    Captions that don't follow the format come back whole as the caption part.
+    """
+    match = _FULL_CAPTION.match(full_caption.strip())
+    if not match:
+        return "", full_caption.strip(), ""
+
+    return match.group("ocr").strip(), match.group("caption").strip(), match.group("humor").strip()
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count without calling the tokenizer:
+    one token per Hangul/CJK character, one per four other characters.
+    """
+    wide = sum(1 for ch in text if ord(ch) >= 0x1100)
+    return wide + (len(text) - wide + 3) // 4
+
+def truncate_to_budget(text: str, budget: int) -> str:
+
+    text = _WHITESPACE.sub(" ", text).strip()
+    if estimate_tokens(text) <= budget:
+        return text
+
+    # Binary search the longest prefix that fits, leaving room for the ellipsis
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget - 1:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return text[:lo].rstrip() + "…" if lo else ""
+
+def first_sentence(text: str) -> str:
+    return _SENTENCE_END.split(text.strip(), maxsplit=1)[0]
+
+def compact_caption(ocr: str, caption: str, humor: str, budget: int = RERANK_TOKEN_BUDGET) -> str:
+    """
+    Builds the short rerank representation of a meme: its OCR text (at most half the budget),
+    then the first sentence of the caption, then the first sentence of the humor explanation
+    while budget remains.
+    """
+    parts = []
+    remaining = budget
+
+    for text, share in ((ocr, budget // 2), (first_sentence(caption), budget), (first_sentence(humor), budget)):
+        # Every part after the first also pays for its " / " separator
+        room = min(share, remaining - (1 if parts else 0))
+        if not text or room <= 2:
+            continue
+        piece = truncate_to_budget(text, room)
+        if piece:
+            parts.append(piece)
+            remaining = budget - estimate_tokens(" / ".join(parts))
+
+    return " / ".join(parts)
+
+def compact_from_full(full_caption: str, budget: int = RERANK_TOKEN_BUDGET) -> str:
+    """
+    Compact rerank caption for rows stored before rerank_caption existed.
+    """
+    return compact_caption(*split_caption(full_caption), budget=budget)
@@ -0,0 +1,138 @@
+import json
+import numpy as np
+from loguru import logger
+from typing import Dict, Iterable, List, Optional, Protocol, Tuple
+from .schema import ImageTrivial
+from .captions import compact_from_full, split_caption
+from .lexindex import LexicalIndex
+
+class CaptionSource(Protocol):
+    """
+    Read-only caption backing, e.g. indexfile.MappedCaptions.
+    """
+    def get(self, image_id: int) -> Optional[ImageTrivial]: ...
+    def items(self) -> Iterable[Tuple[int, ImageTrivial]]: ...
+    # Vector index rows of each tag, if the source keeps them precomputed
+    def tag_rows(self) -> Optional[Dict[str, np.ndarray]]: ...
+
+def build_lexical(captions: Iterable[Tuple[int, ImageTrivial]]) -> LexicalIndex:
+
+    lexical = LexicalIndex()
+    for image_id, image in captions:
+        lexical.add(image_id, split_caption(image.caption)[0])
+
+    return lexical
+
+class CaptionStore:
+    """
+    In-memory image_id -> ImageTrivial (caption, like_cnt) map for rerank candidates.
+    The corpus is small and changes rarely, so the whole thing is held in the serving process
+    and swapped wholesale when its source's watermark moves.
+    The lexical index over the captions' OCR text is kept in step with it, entry by entry.
+    """
+
+    def __init__(self):
+
+        self._captions: Dict[int, ImageTrivial] = {}
+        self.watermark: Optional[str] = None
+        self.lexical = LexicalIndex()
+        # Shared read-only captions (a mapped index file) behind the dict, if attached
+        self._backing: Optional[CaptionSource] = None
+        # Bumped when any image's tags change, so the tag bitsets derived from the store know when to rebuild;
+        # caption-only changes (misses filled from the DB, most reloads) leave it alone
+        self.revision = 0
+
+    def __len__(self) -> int:
+        return len(self._captions)
+
+    def get(self, image_id: int) -> Optional[ImageTrivial]:
+        image = self._captions.get(image_id)
+        if image is None and self._backing is not None:
+            image = self._backing.get(image_id)
+        return image
+
+    def tag_rows(self) -> Optional[Dict[str, np.ndarray]]:
+        """
+        The shared source's precomputed tag rows, if it has them; tags() then only covers the dict.
+        """
+        return self._backing.tag_rows() if self._backing is not None else None
+
+    def tags(self) -> Dict[int, List[str]]:
+        """
+        image_id -> tags. With precomputed tag rows behind the dict, only the dict's entries (all of them,
+        as they override the source's tags); otherwise every tagged image, the source's decoded one by one.
+        """
+        if self.tag_rows() is not None:
+            return {image_id: image.tags for image_id, image in self._captions.items()}
+
+        images = dict(self._backing.items()) if self._backing is not None else {}
+        images.update(self._captions)
+        return {image_id: image.tags for image_id, image in images.items() if image.tags}
+
+    def attach(self, backing: Optional[CaptionSource], lexical: LexicalIndex) -> None:
+        """
+        Puts a shared caption source behind the dict, with a lexical index prebuilt over both (build_lexical).
+        """
+        self._backing = backing
+        self.lexical = lexical
+        self.revision += 1
+        logger.info(f"Caption store attached a shared caption source ({len(lexical)} lexical documents).")
+
+    def _tags_changed(self, image_id: int, image: ImageTrivial) -> bool:
+        old = self.get(image_id)
+        return (old.tags if old is not None else []) != image.tags
+
+    def update(self, captions: Dict[int, ImageTrivial]) -> None:
+        """
+        Adds entries fetched on a miss.
+        """
+        retag = any(self._tags_changed(image_id, image) for image_id, image in captions.items())
+        self._captions.update(captions)
+        if retag:
+            self.revision += 1
+        for image_id, image in captions.items():
+            self.lexical.add(image_id, split_caption(image.caption)[0])
+
+    def replace(self, captions: Dict[int, ImageTrivial], watermark: Optional[str]) -> None:
+        """
+        Swaps in a freshly loaded map; readers never see a half-built one.
+        Only new, changed and removed entries touch the lexical index.
+        """
+        retag = False
+        for image_id in self._captions.keys() - captions.keys():
+            self.lexical.remove(image_id)
+            retag = retag or bool(self._captions[image_id].tags)
+        for image_id, image in captions.items():
+            old = self._captions.get(image_id)
+            if old is None or old.caption != image.caption:
+                self.lexical.add(image_id, split_caption(image.caption)[0])
+            retag = retag or self._tags_changed(image_id, image)
+
+        self._captions = captions
+        self.watermark = watermark
+        if retag:
+            self.revision += 1
+        logger.info(f"Caption store loaded {len(captions)} captions (watermark {watermark}).")
+
+def load_json_captions(path: str) -> Dict[int, ImageTrivial]:
+    """
+    Reads captions from a seed/export images.json (the format dblite.export_json writes).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        items: Iterable[dict] = json.load(f)
+
+    return {
+        item["image_id"]: ImageTrivial(
+            image_id=item["image_id"],
+            caption=item["caption"],
+            # Older exports have no rerank_caption; derive it once at load time
+            rerank_caption=item.get("rerank_caption") or compact_from_full(item["caption"]),
+            like_cnt=item.get("like_cnt") or 0,
+            # Seed format: {"ImageTag": {"create": [{"tag": {"connect": {"tag_name": ...}}}]}}
+            tags=[
+                entry["tag"]["connect"]["tag_name"]
+                for entry in (item.get("ImageTag") or {}).get("create", [])
+            ]
+        )
+        for item in items if item.get("caption")
+    }
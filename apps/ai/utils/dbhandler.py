@@ -1,30 +1,120 @@
 from prisma import Prisma, register
 from prisma.models import Tag, Image, Embedding
+from prisma.partials import ImageCaption
 from .schema import ImageTrivial
-from typing import List
+from .captionstore import CaptionStore, load_json_captions
+from .captions import compact_from_full
+from dotenv import load_dotenv
+from loguru import logger
+from typing import Dict, List, Optional
+from os import getenv, path
+import asyncio
 
+load_dotenv()
+
+# Where the caption store is filled from: "db" (MySQL via Prisma), a path to a seed/export images.json,
+# or "index" (the captions section of the mapped index file; search.py attaches it)
+CAPTION_SOURCE = getenv("CAPTION_SOURCE", "db")
+# Seconds between watermark checks of the caption source
+CAPTION_REFRESH_SEC = float(getenv("CAPTION_REFRESH_SEC", "60"))
+
+# Single client for the whole process; main.py connects it once in its lifespan hook.
+# Prisma's query engine pools connections (tune with `connection_limit` in DATABASE_URL).
 db = Prisma()
 register(db)
 
-# --- async ---
-async def get_meta(inputs: List[int]) -> List[ImageTrivial]:
+caption_store = CaptionStore()
 
-    await db.connect()
+# --- async ---
+async def fetch_captions(ids: Optional[List[int]] = None) -> Dict[int, ImageTrivial]:
+    """
+    One find_many projecting only image_id, captions, like_cnt and tag names; all images if ids is None.
+    """
 
-    rets = []
+    # Standalone use (e.g. search.py's test loop) has no lifespan hook
+    if not db.is_connected():
+        await db.connect()
 
-    for id in inputs:
+    where = {'image_id': {'in': ids}} if ids is not None else None
+    rows = await ImageCaption.prisma().find_many(where=where, include={'ImageTag': {'include': {'tag': True}}})
 
-        i_image = await db.image.find_unique(
-            where={
-                'image_id': id
-            }
+    return {
+        row.image_id: ImageTrivial(
+            image_id=row.image_id,
+            caption=row.caption,
+            # Rows seeded before rerank_caption existed get it derived here, once per load
+            rerank_caption=row.rerank_caption or compact_from_full(row.caption),
+            like_cnt=row.like_cnt,
+            tags=[image_tag.tag.tag_name for image_tag in row.ImageTag or [] if image_tag.tag]
         )
+        for row in rows
+    }
+
+# Order-independent checksum over every column the caption store serves, so edits to existing rows
+# (caption, rerank_caption backfills, like_cnt, tags) move the watermark, not only inserts and deletes
+_CAPTION_CHECKSUM_SQL = """
+SELECT
+    (SELECT CONCAT(COUNT(*), ':', COALESCE(BIT_XOR(CRC32(CONCAT_WS(0x1f, image_id, caption, COALESCE(rerank_caption, ''), like_cnt))), 0)) FROM `Image`) AS images,
+    (SELECT CONCAT(COUNT(*), ':', COALESCE(BIT_XOR(CRC32(CONCAT_WS(0x1f, image_id, tag_id))), 0)) FROM `ImageTag`) AS image_tags,
+    (SELECT CONCAT(COUNT(*), ':', COALESCE(BIT_XOR(CRC32(CONCAT_WS(0x1f, tag_id, tag_name))), 0)) FROM `Tag`) AS tags
+"""
+
+async def caption_watermark() -> str:
+    """
+    Change marker for the caption source: file mtime for JSON, a checksum of the served columns for MySQL.
+    """
+
+    if CAPTION_SOURCE == "index":
+        return "index"
+    if CAPTION_SOURCE != "db":
+        return str(path.getmtime(CAPTION_SOURCE))
+
+    row = (await db.query_raw(_CAPTION_CHECKSUM_SQL))[0]
+
+    return f"{row['images']}|{row['image_tags']}|{row['tags']}"
 
-        if i_image:
-            t_image = ImageTrivial(image_id=i_image.image_id, caption=i_image.caption)
-            rets.append(t_image)
+async def load_caption_store() -> None:
 
-    await db.disconnect()
+    watermark = await caption_watermark()
+
+    if CAPTION_SOURCE == "index":
+        captions = {}
+    elif CAPTION_SOURCE == "db":
+        captions = await fetch_captions()
+    else:
+        captions = await asyncio.to_thread(load_json_captions, CAPTION_SOURCE)
+
+    caption_store.replace(captions, watermark)
+
+async def refresh_caption_store(interval: float = CAPTION_REFRESH_SEC) -> None:
+    """
+    Background task: reloads the caption store whenever the source watermark moves.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await caption_watermark() != caption_store.watermark:
+                await load_caption_store()
+        except Exception as e:
+            logger.error(f"Caption store refresh failed: {e}")
+
+async def get_meta(inputs: List[int]) -> List[ImageTrivial]:
+
+    if not inputs:
+        return []
+
+    # Serve from the in-memory store; only misses go to MySQL
+    missing = [id for id in inputs if caption_store.get(id) is None]
+    if missing:
+        logger.debug(f"Caption store miss for {missing}, falling back to DB.")
+        caption_store.update(await fetch_captions(missing))
+
+    # Keep the vector search order
+    rets = []
+    for id in inputs:
+        image = caption_store.get(id)
+        if image is not None:
+            rets.append(image)
 
-    return rets
\ No newline at end of file
+    return rets
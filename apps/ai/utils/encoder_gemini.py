@@ -3,6 +3,7 @@ from google.genai import types
 from loguru import logger
 from typing import List, Optional
 from dotenv import load_dotenv
+import asyncio
 import time
 import numpy as np
 from numpy.linalg import norm
@@ -11,6 +12,26 @@ load_dotenv()
 
 gemini_client = genai.Client()
 
+VALID_TASK_TYPES = [
+    "RETRIEVAL_QUERY", "RETRIEVAL_DOCUMENT"
+]
+MAX_RETRIES = 2  # Total 3 attempts
+
+def _normalize_embeddings(result: types.EmbedContentResponse) -> List[List[float]]:
+    """
+    Normalize embeddings for consistent similarity search, as per Gemini docs for dimensions != 3072
+    """
+    normalized: List[List[float]] = []
+
+    for embedding in result.embeddings:
+        embedding_np = np.array(embedding.values)
+        # Calculate the L2 norm (magnitude) of the vector
+        norm_value = norm(embedding_np)
+        # Normalize the vector by dividing by its norm, and append it (as a list)
+        normalized.append((embedding_np / norm_value).tolist())
+
+    return normalized
+
 def generate_embedding_gemini(
     texts: List[str], 
     task_type: str = "retrieval_document",
@@ -35,14 +56,10 @@ def generate_embedding_gemini(
         logger.warning("Empty list of texts provided for Gemini embedding.")
         return []
 
-    valid_task_types = [
-        "RETRIEVAL_QUERY", "RETRIEVAL_DOCUMENT"
-    ]
-    if task_type not in valid_task_types:
-        raise ValueError(f"Invalid task_type '{task_type}'. Must be one of {valid_task_types}")
+    if task_type not in VALID_TASK_TYPES:
+        raise ValueError(f"Invalid task_type '{task_type}'. Must be one of {VALID_TASK_TYPES}")
 
     all_embeddings: List[List[float]] = []
-    MAX_RETRIES = 2  # Total 3 attempts
 
     i = 0
     while i < len(texts):
@@ -66,15 +83,7 @@ def generate_embedding_gemini(
                 duration_ms = (time.perf_counter() - start_time) * 1000
                 logger.debug(f"Gemini Batch #{chunk_index} success, took {duration_ms:.1f}ms")
                 
-                # Normalize embeddings for consistent similarity search, as per Gemini docs for dimensions != 3072
-                for embedding in result.embeddings:
-                    embedding_np = np.array(embedding.values)
-                    # Calculate the L2 norm (magnitude) of the vector
-                    norm_value = norm(embedding_np)
-                    # Normalize the vector by dividing by its norm
-                    normalized_embedding = embedding_np / norm_value
-                    # Append the normalized vector (as a list) to our results
-                    all_embeddings.append(normalized_embedding.tolist())
+                all_embeddings.extend(_normalize_embeddings(result))
 
                 batch_success = True
                 break
@@ -95,6 +104,59 @@ def generate_embedding_gemini(
     logger.info(f"Successfully generated {len(all_embeddings)} embeddings using Gemini.")
     return all_embeddings
 
+async def agenerate_embedding_gemini(
+    texts: List[str],
+    task_type: str = "RETRIEVAL_QUERY",
+    batch_size: int = 100
+) -> List[List[float]]:
+    """
+    Async counterpart of generate_embedding_gemini for the serving path.
+    Uses the client's aio surface, so waiting on Gemini never blocks the event loop.
+
+    :param texts: List of input texts to embed.
+    :param task_type: The task type for the embedding. Defaults to "RETRIEVAL_QUERY".
+    :param batch_size: The number of texts to process in a single API call. Gemini's limit is 100.
+    :return: A list of embedding vectors.
+    :raises ValueError: If an invalid task_type is provided.
+    """
+    if not texts:
+        logger.warning("Empty list of texts provided for Gemini embedding.")
+        return []
+
+    if task_type not in VALID_TASK_TYPES:
+        raise ValueError(f"Invalid task_type '{task_type}'. Must be one of {VALID_TASK_TYPES}")
+
+    all_embeddings: List[List[float]] = []
+
+    for i in range(0, len(texts), batch_size):
+        chunk = texts[i : i + batch_size]
+        chunk_index = i // batch_size
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                start_time = time.perf_counter()
+
+                result = await gemini_client.aio.models.embed_content(
+                    model="gemini-embedding-001",
+                    contents=chunk,
+                    config=types.EmbedContentConfig(task_type=task_type, output_dimensionality=768)
+                )
+
+                duration_ms = (time.perf_counter() - start_time) * 1000
+                logger.debug(f"Gemini Batch #{chunk_index} success, took {duration_ms:.1f}ms")
+
+                all_embeddings.extend(_normalize_embeddings(result))
+                break
+            except Exception as e:
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"Gemini Batch #{chunk_index} failed (Attempt {attempt + 1}/{MAX_RETRIES}): {e}. Retrying in 1s.")
+                    await asyncio.sleep(1)
+                else:
+                    logger.error(f"Gemini Batch #{chunk_index} failed after {MAX_RETRIES + 1} attempts. Aborting.")
+                    return all_embeddings
+
+    return all_embeddings
+
 if __name__ == "__main__":
     # This block allows you to test the function by running `python -m apps.ai.utils.encoder_gemini`
     # from the memeforyou-server directory.
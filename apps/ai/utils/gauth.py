@@ -7,13 +7,20 @@ import os
 
 load_dotenv()
 
-CRED = Credentials.from_service_account_info(
-    json.loads(os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON"))
-)
+def get_cred() -> Credentials:
+
+    return Credentials.from_service_account_info(
+        json.loads(os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON"))
+    )
 
 def get_client(database: str) -> firestore.Client:
 
-    client = firestore.Client(credentials=CRED, database=database)
+    client = firestore.Client(credentials=get_cred(), database=database)
 
     return client
 
+def get_async_client(database: str) -> firestore.AsyncClient:
+
+    client = firestore.AsyncClient(credentials=get_cred(), database=database)
+
+    return client
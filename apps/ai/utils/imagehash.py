@@ -0,0 +1,21 @@
+from PIL import Image
+import numpy as np
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    """
+    Difference hash: grayscale, resize to (size + 1) x size, and set one bit per
+    horizontally adjacent pixel pair depending on which is brighter.
+    Robust to rescaling and recompression, so CDN reposts of one meme land within a few bits.
+    """
+    gray = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+
+    return value
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
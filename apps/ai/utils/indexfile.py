@@ -0,0 +1,201 @@
+import json
+import mmap
+import os
+import numpy as np
+from loguru import logger
+from typing import Dict, Iterator, List, Optional, Tuple
+from .captions import split_caption
+from .lexindex import NGRAM, LexicalIndex, MappedPostings, build_postings
+from .schema import ImageTrivial
+from .vindex import LocalVectorIndex, coarse_codes, quantize
+
+# Single-file serving index, opened with mmap so every worker shares one copy in the page cache:
+#
+#   MAGIC | uint32 header length | JSON header | zero padding up to HEADER_SIZE
+#   sections, each starting on an ALIGN boundary:
+#     ids (int64 n), order (int64 n, argsort of ids), sorted_ids (int64 n),
+#     matrix (float32 n x dim, unit rows), codes (int8 n x dim), scales (float32 n),
+#     caption_offsets (uint64 n + 1), captions (utf-8 JSON per row, concatenated),
+#     gram_keys, gram_offsets, gram_ids, lexical_doc_ids (OCR n-gram postings, see lexindex.build_postings),
+#     tag_offsets (uint64 tags + 1), tag_rows (int64 rows of each tag, in header "tags" order)
+#
+# The header maps each section name to [offset, dtype, shape]. The caption, postings and tag sections
+# are only written with captions; files without them still open, with the lexical and tag indexes built in process.
+MAGIC = b"M4YINDEX"
+FORMAT_VERSION = 1
+ALIGN = 64
+HEADER_SIZE = 4096
+
+def _pad(length: int) -> int:
+    return -length % ALIGN
+
+def write_index_file(path: str, index: LocalVectorIndex, captions: Optional[Dict[int, ImageTrivial]] = None) -> None:
+    """
+    Serializes `index` (and the captions of its rows, if given) into one index file.
+    Written to a temp file and renamed, so workers mapping the old file are never disturbed.
+    """
+    matrix = np.ascontiguousarray(index.matrix, dtype=np.float32)
+    codes, scales = quantize(matrix, "int8")
+    extra = {}
+
+    sections = {
+        "ids": np.ascontiguousarray(index.ids, dtype=np.int64),
+        "order": np.ascontiguousarray(index.order, dtype=np.int64),
+        "sorted_ids": np.ascontiguousarray(index.sorted_ids, dtype=np.int64),
+        "matrix": matrix,
+        "codes": codes,
+        "scales": scales,
+    }
+    if captions is not None:
+        blobs = []
+        for image_id in index.ids:
+            image = captions.get(int(image_id))
+            blobs.append(image.model_dump_json().encode("utf-8") if image else b"")
+        sections["caption_offsets"] = np.concatenate([[0], np.cumsum([len(blob) for blob in blobs])]).astype(np.uint64)
+        sections["captions"] = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+
+        # Lexical postings over the OCR text, and the rows of each tag, so workers map them instead of building them
+        postings = build_postings(
+            (int(image_id), split_caption(captions[int(image_id)].caption)[0]) for image_id in index.ids if int(image_id) in captions
+        )
+        sections.update({("lexical_" + name if name == "doc_ids" else name): array for name, array in postings.items()})
+
+        rows_by_tag: Dict[str, List[int]] = {}
+        for row, image_id in enumerate(index.ids):
+            image = captions.get(int(image_id))
+            for tag in (image.tags if image else ()):
+                rows_by_tag.setdefault(tag, []).append(row)
+        tags = sorted(rows_by_tag)
+        sections["tag_offsets"] = np.concatenate([[0], np.cumsum([len(rows_by_tag[tag]) for tag in tags])]).astype(np.uint64)
+        sections["tag_rows"] = np.asarray([row for tag in tags for row in rows_by_tag[tag]], dtype=np.int64)
+        extra = {"lexical_n": NGRAM, "tags": tags}
+
+    # Lay the sections out after a fixed-size header block
+    layout = {}
+    offset = HEADER_SIZE
+    for name, array in sections.items():
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        offset += array.nbytes + _pad(array.nbytes)
+
+    header = json.dumps({
+        "format": FORMAT_VERSION,
+        "n": len(index),
+        "dim": index.dim,
+        "version": index.version,
+        **extra,
+        "sections": layout,
+    }).encode("utf-8")
+    if len(MAGIC) + 4 + len(header) > HEADER_SIZE:
+        raise ValueError("Index file header does not fit in its reserved block.")
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + len(header).to_bytes(4, "little") + header)
+        f.write(b"\0" * (HEADER_SIZE - f.tell()))
+        for name, array in sections.items():
+            f.write(array.tobytes())
+            f.write(b"\0" * _pad(array.nbytes))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    logger.success(f"Wrote index file {path} ({len(index)} vectors, {offset / 2**20:.1f} MiB).")
+
+class MappedCaptions:
+    """
+    Read-only captions backed by an index file's caption section; entries are decoded on access.
+    The file's lexical postings and tag rows, if it has them, are mapped alongside,
+    so the derived indexes never need to decode every caption.
+    """
+
+    def __init__(
+        self, index: LocalVectorIndex, offsets: np.ndarray, blob: np.ndarray,
+        postings: Optional[MappedPostings] = None, tag_rows: Optional[Dict[str, np.ndarray]] = None
+    ):
+        self.index = index
+        self._offsets = offsets
+        self._blob = blob
+        self._postings = postings
+        self._tag_rows = tag_rows
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _decode(self, row: int) -> Optional[ImageTrivial]:
+        start, stop = int(self._offsets[row]), int(self._offsets[row + 1])
+        if start == stop:
+            return None
+        return ImageTrivial.model_validate_json(self._blob[start:stop].tobytes())
+
+    def get(self, image_id: int) -> Optional[ImageTrivial]:
+        row = int(self.index.rows_of([image_id])[0])
+        return self._decode(row) if row >= 0 else None
+
+    def items(self) -> Iterator[Tuple[int, ImageTrivial]]:
+        for row, image_id in enumerate(self.index.ids):
+            image = self._decode(row)
+            if image is not None:
+                yield int(image_id), image
+
+    def lexical(self) -> Optional[LexicalIndex]:
+        """
+        A lexical index over the mapped postings, or None if the file has none.
+        """
+        return LexicalIndex(base=self._postings) if self._postings is not None else None
+
+    def tag_rows(self) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Index rows of each tag, or None if the file has no tag section.
+        """
+        return self._tag_rows
+
+def open_index_file(path: str, precision: str = "float32", rescore_mult: int = 4, coarse_dim: Optional[int] = None) -> Tuple[LocalVectorIndex, Optional[MappedCaptions]]:
+    """
+    Maps an index file read-only. Every array is a view into the mapping: nothing is parsed or copied,
+    and all workers mapping the same file share its pages.
+    float16 and Matryoshka prefixes (coarse_dim) have no section in the file and are built in process memory.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not an index file.")
+    header_len = int.from_bytes(mm[len(MAGIC):len(MAGIC) + 4], "little")
+    header = json.loads(mm[len(MAGIC) + 4:len(MAGIC) + 4 + header_len])
+    if header["format"] != FORMAT_VERSION:
+        raise ValueError(f"{path} has index format {header['format']}, expected {FORMAT_VERSION}.")
+
+    def section(name: str) -> np.ndarray:
+        offset, dtype, shape = header["sections"][name]
+        count = int(np.prod(shape))
+        return np.frombuffer(mm, dtype=np.dtype(dtype), count=count, offset=offset).reshape(shape)
+
+    matrix = section("matrix")
+    codes = scales = None
+    if coarse_dim and coarse_dim < header["dim"]:
+        codes, scales = coarse_codes(matrix, precision, coarse_dim)
+    elif precision == "int8":
+        codes, scales = section("codes"), section("scales")
+    elif precision == "float16":
+        codes, scales = quantize(matrix, "float16")
+
+    index = LocalVectorIndex.from_arrays(
+        ids=section("ids"), matrix=matrix, version=header["version"],
+        order=section("order"), sorted_ids=section("sorted_ids"),
+        precision=precision, rescore_mult=rescore_mult, codes=codes, scales=scales
+    )
+
+    captions = None
+    if "captions" in header["sections"]:
+        postings = tag_rows = None
+        if "gram_keys" in header["sections"]:
+            postings = MappedPostings(
+                header["lexical_n"], section("gram_keys"), section("gram_offsets"), section("gram_ids"), section("lexical_doc_ids")
+            )
+        if "tag_rows" in header["sections"]:
+            tag_offsets, rows = section("tag_offsets"), section("tag_rows")
+            tag_rows = {tag: rows[int(tag_offsets[i]):int(tag_offsets[i + 1])] for i, tag in enumerate(header["tags"])}
+        captions = MappedCaptions(index, section("caption_offsets"), section("captions"), postings, tag_rows)
+
+    logger.info(f"Mapped {len(index)} vectors ({index.dim} dims, {precision}) from {path}.")
+    return index, captions
@@ -0,0 +1,122 @@
+import os
+import numpy as np
+from loguru import logger
+from typing import List, Optional
+from .schema import VectorHit
+from .vindex import LocalVectorIndex, _topk
+
+def _assign(X: np.ndarray, centroids: np.ndarray, block: int = 8192) -> np.ndarray:
+    """
+    Nearest centroid (by cosine) of every row, in blocks to bound the (block x nlist) score matrix.
+    """
+    out = np.empty(X.shape[0], dtype=np.int32)
+    for start in range(0, X.shape[0], block):
+        out[start:start + block] = np.argmax(X[start:start + block] @ centroids.T, axis=1)
+
+    return out
+
+def spherical_kmeans(X: np.ndarray, nlist: int, iters: int = 20, max_train: int = 256, seed: int = 0) -> np.ndarray:
+    """
+    k-means on unit vectors with cosine assignment and re-normalized centroids.
+    Trains on at most max_train points per list, which is plenty for coarse quantization.
+    """
+    rng = np.random.default_rng(seed)
+    if X.shape[0] > nlist * max_train:
+        X = X[rng.choice(X.shape[0], size=nlist * max_train, replace=False)]
+    X = np.asarray(X, dtype=np.float32)
+
+    centroids = X[rng.choice(X.shape[0], size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(X, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, X)
+        counts = np.bincount(assign, minlength=nlist)
+
+        # Empty lists get re-seeded with random points
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = X[rng.choice(X.shape[0], size=empty.shape[0], replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+
+    return centroids.astype(np.float32)
+
+class IVFIndex:
+    """
+    Inverted-file ANN index over a LocalVectorIndex: k-means centroids partition the rows into nlist lists,
+    and a query only scores the rows of its nprobe closest lists.
+    With nlist ~ sqrt(n), a query touches about nlist + nprobe * n / nlist rows instead of n.
+
+    Rows are stored grouped by list (order[offsets[i]:offsets[i + 1]] are list i's rows), so a probe is a slice.
+    Built offline by preps/ivfbuild.py; tied to the index version it was built against.
+    """
+
+    def __init__(self, index: LocalVectorIndex, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray, nprobe: int = 8):
+
+        self.index = index
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.nlist = self.centroids.shape[0]
+        self.nprobe = nprobe
+
+    @property
+    def version(self) -> str:
+        return self.index.version
+
+    @classmethod
+    def build(cls, index: LocalVectorIndex, nlist: Optional[int] = None, iters: int = 20, **kwargs) -> "IVFIndex":
+
+        n = len(index)
+        nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+        matrix = np.asarray(index.matrix)
+
+        centroids = spherical_kmeans(matrix, nlist, iters=iters)
+        assign = _assign(matrix, centroids)
+
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        logger.info(f"Built IVF index: {n} vectors in {nlist} lists (largest {int(np.max(np.diff(offsets)))}).")
+
+        return cls(index, centroids, order, offsets, **kwargs)
+
+    def save(self, path: str) -> None:
+        """
+        Writes the index to exactly `path` (no .npz suffix is appended), through a temp file in the same directory
+        renamed over it, so a server loading it mid-write sees the old or the new file, never a partial one.
+        """
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets, version=np.array(self.version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, index: LocalVectorIndex, **kwargs) -> Optional["IVFIndex"]:
+        """
+        Loads a saved IVF index for `index`, or None if it was built against a different corpus.
+        """
+        data = np.load(path)
+        if str(data["version"]) != index.version:
+            logger.warning(f"{path} was built for index version {data['version']}, not {index.version}. Rebuild it.")
+            return None
+
+        ivf = cls(index, data["centroids"], data["order"], data["offsets"], **kwargs)
+        logger.info(f"Loaded IVF index with {ivf.nlist} lists from {path}.")
+        return ivf
+
+    def search(self, query, k: int = 5, nprobe: Optional[int] = None, mask: Optional[np.ndarray] = None) -> List[VectorHit]:
+        """
+        Approximate cosine top-k: score the centroids, then only the rows of the nprobe best lists.
+        """
+        q = np.asarray(query, dtype=np.float32)
+        lists = _topk(self.centroids @ q, min(nprobe or self.nprobe, self.nlist))
+
+        rows = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        if mask is not None:
+            rows = rows[mask[rows]]
+
+        return self.index.search_rows(q, rows, k)
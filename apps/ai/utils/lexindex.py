@@ -0,0 +1,173 @@
+import math
+import re
+import unicodedata
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from .schema import VectorHit
+
+# n of the character n-grams the serving index uses
+NGRAM = 2
+
+# Everything but letters (incl. Hangul) and digits; Korean spacing in OCR text is unreliable, so it goes too
+_NON_WORD = re.compile(r"[\W_]+")
+
+def char_ngrams(text: str, n: int = 2) -> Set[str]:
+    """
+    Character n-grams of the normalized text. Hangul syllables carry a lot of information each,
+    so bigrams match quoted meme text regardless of spacing or particles around it.
+    """
+    text = _NON_WORD.sub("", unicodedata.normalize("NFC", text).lower())
+    if len(text) < n:
+        return {text} if text else set()
+
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def gram_key(gram: str) -> int:
+    """
+    Integer key of an n-gram: its code points, 21 bits each (so up to 3-grams fit in a uint64).
+    """
+    key = 0
+    for char in gram:
+        key = (key << 21) | ord(char)
+    return key
+
+def build_postings(docs: Iterable[Tuple[int, str]], n: int = NGRAM) -> Dict[str, np.ndarray]:
+    """
+    Offline postings for MappedPostings, as arrays to store in an index file:
+    gram_keys (sorted uint64), gram_offsets (uint64, one more than keys), gram_ids (int64 image_ids per key),
+    doc_ids (sorted int64 image_ids of the documents with at least one n-gram).
+    """
+    postings: Dict[int, List[int]] = {}
+    doc_ids = []
+    for image_id, text in docs:
+        grams = char_ngrams(text, n)
+        if grams:
+            doc_ids.append(image_id)
+        for gram in grams:
+            postings.setdefault(gram_key(gram), []).append(image_id)
+
+    keys = sorted(postings)
+    lists = [np.sort(np.asarray(postings[key], dtype=np.int64)) for key in keys]
+    return {
+        "gram_keys": np.asarray(keys, dtype=np.uint64),
+        "gram_offsets": np.concatenate([[0], np.cumsum([len(ids) for ids in lists])]).astype(np.uint64),
+        "gram_ids": np.concatenate(lists) if lists else np.empty(0, dtype=np.int64),
+        "doc_ids": np.sort(np.asarray(doc_ids, dtype=np.int64)),
+    }
+
+class MappedPostings:
+    """
+    Read-only n-gram postings (build_postings) viewed straight from an index file's mapping,
+    so workers share them instead of each building Python sets.
+    """
+
+    def __init__(self, n: int, keys: np.ndarray, offsets: np.ndarray, ids: np.ndarray, doc_ids: np.ndarray):
+
+        self.n = n
+        self._keys = keys
+        self._offsets = offsets
+        self._ids = ids
+        self._doc_ids = doc_ids
+
+    def __len__(self) -> int:
+        return self._doc_ids.shape[0]
+
+    def get(self, gram: str) -> np.ndarray:
+
+        key = np.uint64(gram_key(gram))
+        i = int(np.searchsorted(self._keys, key))
+        if i == self._keys.shape[0] or self._keys[i] != key:
+            return self._ids[:0]
+
+        return self._ids[int(self._offsets[i]):int(self._offsets[i + 1])]
+
+    def __contains__(self, image_id: int) -> bool:
+        i = int(np.searchsorted(self._doc_ids, image_id))
+        return i < self._doc_ids.shape[0] and int(self._doc_ids[i]) == image_id
+
+class LexicalIndex:
+    """
+    In-process inverted index: character n-gram -> image_ids whose (OCR) text contains it.
+    Documents are added and removed one at a time, so it follows the caption store without rebuilds.
+
+    With a mapped base (MappedPostings from the index file), the in-process part only holds documents
+    added since; adding or removing a base document shadows its mapped postings.
+    """
+
+    def __init__(self, n: int = NGRAM, base: Optional[MappedPostings] = None):
+
+        self.n = base.n if base is not None else n
+        self._base = base
+        self._postings: Dict[str, Set[int]] = {}
+        self._docs: Dict[int, Set[str]] = {}
+        # Base documents overridden (re-added or removed) in process
+        self._shadowed: Set[int] = set()
+
+    def __len__(self) -> int:
+        base = len(self._base) - len(self._shadowed) if self._base is not None else 0
+        return base + len(self._docs)
+
+    def add(self, image_id: int, text: str) -> None:
+
+        grams = char_ngrams(text, self.n)
+        if self._docs.get(image_id) == grams:
+            return
+
+        self.remove(image_id)
+        if not grams:
+            return
+
+        self._docs[image_id] = grams
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(image_id)
+
+    def remove(self, image_id: int) -> None:
+
+        if self._base is not None and image_id in self._base:
+            self._shadowed.add(image_id)
+
+        for gram in self._docs.pop(image_id, ()):
+            posting = self._postings[gram]
+            posting.discard(image_id)
+            if not posting:
+                del self._postings[gram]
+
+    def _posting(self, gram: str) -> np.ndarray:
+
+        ids = np.fromiter(self._postings.get(gram, ()), dtype=np.int64)
+        if self._base is None:
+            return ids
+
+        base = self._base.get(gram)
+        if self._shadowed:
+            base = base[~np.isin(base, np.fromiter(self._shadowed, dtype=np.int64))]
+
+        return np.concatenate([base, ids]) if ids.shape[0] else base
+
+    def search(self, query: str, k: int = 10, min_coverage: float = 0.6, min_grams: int = 1) -> List[VectorHit]:
+        """
+        Scores each document by the IDF-weighted share of the query's n-grams it contains (0..1),
+        keeping those covering at least min_coverage of the query, best first.
+        Queries with fewer than min_grams distinct n-grams return nothing: one or two bigrams give
+        full coverage to every document containing them, so the hits carry no ranking signal.
+        """
+        grams = char_ngrams(query, self.n)
+        total = len(self)
+        if len(grams) < max(1, min_grams) or not total:
+            return []
+
+        postings = [self._posting(gram) for gram in grams]
+        weights = [math.log(1 + total / (1 + posting.shape[0])) for posting in postings]
+        norm = sum(weights)
+
+        ids = np.concatenate(postings)
+        if not ids.shape[0]:
+            return []
+        image_ids, inverse = np.unique(ids, return_inverse=True)
+        coverage = np.bincount(inverse, weights=np.repeat(weights, [posting.shape[0] for posting in postings])) / norm
+
+        keep = np.flatnonzero(coverage >= min_coverage)
+        # Best coverage first, ties by image_id
+        keep = keep[np.lexsort((image_ids[keep], -coverage[keep]))][:k]
+
+        return [VectorHit(image_id=int(image_ids[i]), score=float(coverage[i])) for i in keep]
@@ -0,0 +1,21 @@
+from os import getenv
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+
+# Prometheus text exposition format
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Seconds; wide enough for a local matmul at the bottom and a slow Gemini call at the top
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def render() -> bytes:
+    """
+    All metrics in the text exposition format.
+    With PROMETHEUS_MULTIPROC_DIR set (uvicorn --workers N), prometheus_client keeps every worker's samples
+    in files there, and this merges them, so any worker answers a scrape for the whole server.
+    """
+    if getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+
+    return generate_latest(REGISTRY)
@@ -0,0 +1,156 @@
+import asyncio
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from loguru import logger
+from os import getpid, listdir, makedirs, path, remove
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+# (stage, seconds) of the current request, in completion order; None outside a tracked request.
+# Tasks spawned by the request (gather) copy the context and append to the same list;
+# single-flight computations record into their own list, which every caller sharing them copies.
+request_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_timings", default=None)
+
+def record_timing(name: str, seconds: float) -> None:
+    """
+    Adds a stage duration to the current request's timings; a no-op outside track_timings().
+    """
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+@contextmanager
+def track_timings() -> Iterator[List[Tuple[str, float]]]:
+    """
+    Collects record_timing() calls made while the with-block runs, then appends its own ("total", seconds).
+    """
+    timings: List[Tuple[str, float]] = []
+    token = request_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings.append(("total", time.perf_counter() - started))
+        request_timings.reset(token)
+
+def server_timing(timings: List[Tuple[str, float]]) -> str:
+    """
+    Server-Timing header value, e.g. "embed;dur=41.2, vector_search;dur=0.9, total;dur=812.5".
+    Repeated stages (a batch's reranks) are summed; the order of first completion is kept.
+    """
+    merged: Dict[str, float] = {}
+    for name, seconds in timings:
+        merged[name] = merged.get(name, 0.0) + seconds
+
+    return ", ".join(f"{name};dur={seconds * 1e3:.1f}" for name, seconds in merged.items())
+
+class StackSampler:
+    """
+    Samples one thread's Python stack every `interval` seconds from a background thread
+    and counts identical stacks, i.e. folded stacks as flamegraph.pl and speedscope read them.
+
+    Sampling the event loop thread shows where a request spends CPU on the loop; time spent
+    awaiting I/O shows up as the selector's poll. Other requests running on the same loop
+    during the profile are sampled too.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None):
+
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.counts: Dict[str, int] = {}
+        self.samples = 0
+        self.path: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if not stack:
+            return
+
+        folded = ";".join(reversed(stack))
+        self.counts[folded] = self.counts.get(folded, 0) + 1
+        self.samples += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, directory: str, label: str = "profile") -> str:
+        """
+        Writes the folded stacks to <directory>/<timestamp>-<pid>-<label>.folded and returns the path.
+        """
+        makedirs(directory, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{getpid()}-{label}.folded"
+        self.path = path.join(directory, name)
+
+        with open(self.path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+        logger.info(f"Wrote {self.samples} stack samples to {self.path}.")
+        return self.path
+
+def prune_profiles(directory: str, keep: int) -> None:
+    """
+    Removes all but the newest `keep` .folded files in `directory` (names start with a timestamp).
+    Workers race on the same files, so ones already gone are skipped.
+    """
+    profiles = sorted(f for f in listdir(directory) if f.endswith(".folded"))
+    for old in profiles[:-keep] if keep > 0 else profiles:
+        try:
+            remove(path.join(directory, old))
+        except FileNotFoundError:
+            pass
+
+# One profile at a time per process: the sampler watches the whole event loop thread
+_profiling = threading.Lock()
+
+def _flush(sampler: StackSampler, directory: str, label: str, keep: int) -> None:
+
+    try:
+        sampler.write(directory, label)
+        prune_profiles(directory, keep)
+    except OSError as e:
+        logger.error(f"Could not write profile: {e}")
+
+@asynccontextmanager
+async def sample_stacks(enabled: bool, directory: str, label: str = "profile", interval: float = 0.005, keep: int = 50) -> AsyncIterator[Optional[StackSampler]]:
+    """
+    Profiles the async-with block into a folded-stack file if `enabled` and no other profile is running,
+    keeping only the newest `keep` files in `directory`.
+    The sampler stops as soon as the block exits; the file write and prune run in a worker thread, off the event loop.
+    Yields the sampler (its .path is set once the block exits), or None when not profiling,
+    in which case nothing is started at all.
+    """
+    if not enabled or not _profiling.acquire(blocking=False):
+        yield None
+        return
+
+    sampler = StackSampler(interval=interval)
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        _profiling.release()
+        await asyncio.to_thread(_flush, sampler, directory, label, keep)
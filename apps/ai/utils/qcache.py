@@ -0,0 +1,168 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from loguru import logger
+from typing import Dict, List, Optional, Tuple
+
+# Trailing noise that doesn't change what the user means for retrieval:
+# punctuation, Korean jamo laughter/crying (ㅋㅋ, ㅎㅎ, ㅠㅠ, ㅜㅜ, ㄷㄷ), ^^ / ;; style emoticons and emoji
+_TRAILING_NOISE = re.compile(
+    r"[\s.,!?~…·^;:'\"()\[\]\-_=+*ㅋㅎㅠㅜㄷㄱ"
+    r"\u2600-\u27bf\U0001f000-\U0001faff\ufe0f\u200d]+$"
+)
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_query(text: str) -> str:
+    """
+    Normalizes a user query into a cache key.
+    Unicode NFC, lowercase, collapsed whitespace, and stripped trailing punctuation/emoticons,
+    so "늦잠 잤다ㅋㅋ" and "늦잠  잤다!!" share one entry.
+    Falls back to the whitespace-collapsed text if nothing would be left.
+    """
+    text = unicodedata.normalize("NFC", text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    stripped = _TRAILING_NOISE.sub("", text)
+
+    return stripped.lower() if stripped else text.lower()
+
+class QueryEmbeddingCache:
+    """
+    LRU + TTL cache for query embeddings, keyed by normalize_query().
+    An optional SQLite file acts as a second tier, so cached queries survive restarts.
+
+    The SQLite tier never runs on the event loop: lookups go through asyncio.to_thread,
+    and writes are queued and flushed in batches by a write-behind task.
+    Rows older than the TTL are purged on open and then at most every PURGE_SEC.
+    """
+
+    PURGE_SEC = 3600.0
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 86400.0, db_path: Optional[str] = None):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._mem: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._pending: Dict[str, Tuple[float, bytes]] = {}
+        self._writer: Optional[asyncio.Task] = None
+        self._purged_at = 0.0
+
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS QueryEmbedding (
+                query_key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_queryembedding_created_at ON QueryEmbedding(created_at)")
+            self._conn.commit()
+            self._purge()
+            logger.info(f"Query embedding cache backed by {db_path}.")
+
+    def _remember(self, key: str, created_at: float, vector: List[float]) -> None:
+
+        self._mem[key] = (created_at, vector)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.maxsize:
+            self._mem.popitem(last=False)
+
+    def _purge(self) -> None:
+        """
+        Deletes rows past the TTL. Runs in the caller's thread (startup or the writer thread).
+        """
+        now = time.time()
+        with self._db_lock:
+            deleted = self._conn.execute("DELETE FROM QueryEmbedding WHERE created_at < ?", (now - self.ttl,)).rowcount
+            self._conn.commit()
+        self._purged_at = now
+
+        if deleted:
+            logger.info(f"Purged {deleted} expired query embeddings.")
+
+    def _load(self, key: str) -> Optional[Tuple[bytes, float]]:
+
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT vector, created_at FROM QueryEmbedding WHERE query_key = ?", (key,)
+            ).fetchone()
+
+    def _store(self, rows: Dict[str, Tuple[float, bytes]]) -> None:
+
+        with self._db_lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO QueryEmbedding (query_key, vector, created_at) VALUES (?, ?, ?)",
+                [(key, blob, created_at) for key, (created_at, blob) in rows.items()]
+            )
+            self._conn.commit()
+
+        if time.time() - self._purged_at >= self.PURGE_SEC:
+            self._purge()
+
+    async def get(self, key: str) -> Optional[List[float]]:
+
+        now = time.time()
+
+        entry = self._mem.get(key)
+        if entry is not None:
+            if now - entry[0] <= self.ttl:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._mem[key]
+
+        if self._conn is not None:
+            pending = self._pending.get(key)
+            row = (pending[1], pending[0]) if pending else await asyncio.to_thread(self._load, key)
+            if row and now - row[1] <= self.ttl:
+                vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                self._remember(key, row[1], vector)
+                self.hits += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, vector: List[float]) -> None:
+        """
+        Caches in memory right away; the SQLite write is queued for the write-behind task.
+        """
+        now = time.time()
+        self._remember(key, now, vector)
+
+        if self._conn is not None:
+            self._pending[key] = (now, np.asarray(vector, dtype=np.float32).tobytes())
+            if self._writer is None or self._writer.done():
+                self._writer = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self) -> None:
+        """
+        Flushes queued writes in batches until the queue is empty; puts arriving during a flush join the next batch.
+        """
+        while self._pending:
+            rows, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._store, rows)
+            except Exception as e:
+                logger.error(f"Query embedding cache write failed: {e}")
+
+    async def close(self) -> None:
+        """
+        Waits for queued writes to reach SQLite, then closes it.
+        """
+        if self._writer is not None:
+            await self._writer
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+            self._conn = None
@@ -0,0 +1,109 @@
+import time
+import numpy as np
+from loguru import logger
+from typing import Any, List, Optional
+from .schema import RankedResponse
+
+class SemanticResultCache:
+    """
+    Caches reranked results by query embedding rather than by query text.
+    A new query reuses an entry when its cosine similarity to the cached query vector
+    is at least `threshold` and the requested count and scope (e.g. search engine and tag filter) match,
+    so paraphrases skip the rerank.
+
+    Entries are tagged with the index version they were computed against and only match lookups
+    for that version, so several corpora (e.g. Firestore and a tag-filtered local search) can share the cache;
+    invalidate(version) frees a superseded version's entries right away.
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 512, ttl: float = 3600.0):
+
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # Slot-based storage: row i of _vectors belongs to _responses[i]
+        self._vectors: Optional[np.ndarray] = None
+        self._counts = np.zeros(maxsize, dtype=np.int64)
+        self._scopes = np.full(maxsize, "", dtype=object)
+        self._versions = np.full(maxsize, "", dtype=object)
+        self._created = np.zeros(maxsize, dtype=np.float64)
+        self._last_used = np.zeros(maxsize, dtype=np.float64)
+        self._responses: List[Optional[RankedResponse]] = [None] * maxsize
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def invalidate(self, version: Optional[str] = None) -> None:
+        """
+        Drops the entries computed against `version`, or every entry if it is None.
+        """
+        n = self._size
+        keep = np.zeros(n, dtype=bool) if version is None else self._versions[:n] != version
+        dropped = n - int(np.count_nonzero(keep))
+        if not dropped:
+            return
+
+        # Compact the surviving entries into the front slots
+        kept = np.flatnonzero(keep)
+        self._size = kept.shape[0]
+        if self._vectors is not None:
+            self._vectors[:self._size] = self._vectors[kept]
+        for field in (self._counts, self._scopes, self._versions, self._created, self._last_used):
+            field[:self._size] = field[kept]
+        self._responses = [self._responses[i] for i in kept] + [None] * (self.maxsize - self._size)
+
+        logger.info(f"Invalidated {dropped} cached results (index version {version or 'all'}).")
+
+    def lookup(self, vector: Any, count: int, version: str, scope: str = "") -> Optional[RankedResponse]:
+
+        if self._size == 0:
+            self.misses += 1
+            return None
+
+        q = np.asarray(vector, dtype=np.float32)
+        now = time.time()
+        n = self._size
+
+        scores = self._vectors[:n] @ q
+        valid = (
+            (self._counts[:n] == count) & (self._scopes[:n] == scope) & (self._versions[:n] == version)
+            & (now - self._created[:n] <= self.ttl)
+        )
+        scores[~valid] = -np.inf
+
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            self._last_used[best] = now
+            self.hits += 1
+            logger.debug(f"Semantic result cache hit (similarity {scores[best]:.4f}).")
+            return self._responses[best]
+
+        self.misses += 1
+        return None
+
+    def store(self, vector: Any, count: int, version: str, response: RankedResponse, scope: str = "") -> None:
+
+        q = np.asarray(vector, dtype=np.float32)
+        if self._vectors is None or self._vectors.shape[1] != q.shape[0]:
+            self._vectors = np.zeros((self.maxsize, q.shape[0]), dtype=np.float32)
+            self._size = 0
+
+        # Fill free slots first, then evict the least recently used entry
+        if self._size < self.maxsize:
+            slot = self._size
+            self._size += 1
+        else:
+            slot = int(np.argmin(self._last_used))
+
+        now = time.time()
+        self._vectors[slot] = q
+        self._counts[slot] = count
+        self._scopes[slot] = scope
+        self._versions[slot] = version
+        self._created[slot] = now
+        self._last_used[slot] = now
+        self._responses[slot] = response
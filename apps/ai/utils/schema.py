@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 
 # --- Models for prep ---
 
@@ -34,9 +34,20 @@ class IndvMemeReturn(BaseModel):
 class GeminiResponse(BaseModel):
     text: List[IndvMemeReturn]
 
+# Pipeline result; degraded is set when the Gemini rerank was replaced by the local fallback ranking
+class RankedResponse(GeminiResponse):
+    degraded: bool = False
+
 class ImageTrivial(BaseModel):
     image_id: int
     caption: str
+    rerank_caption: Optional[str] = None
+    like_cnt: int = 0
+    tags: List[str] = []
+
+class VectorHit(BaseModel):
+    image_id: int
+    score: float
 
 # --- Models for main FastAPI API ---
 
@@ -44,8 +55,35 @@ class ImageTrivial(BaseModel):
 class InputData(BaseModel):
     text: str = Field(..., examples=['늦잠 자서 수업을 째 버렸어'], description="유저 텍스트 입력 값")
     count: int = Field(..., examples=[5, 10], description="반환받을 밈 개수")
+    include_tags: List[str] = Field([], examples=[['웃긴', '동물']], description="모두 포함해야 하는 태그")
+    exclude_tags: List[str] = Field([], examples=[['슬픈']], description="하나라도 있으면 제외할 태그")
+    nprobe: Optional[int] = Field(None, ge=1, examples=[8, 32], description="ivf 엔진에서 탐색할 리스트 수 (클수록 느리고 정확함)")
+
+# Batch input data class
+class BatchInputData(BaseModel):
+    texts: List[str] = Field(..., min_length=1, max_length=100, examples=[['늦잠 자서 수업을 째 버렸어', '시험 망했다']], description="유저 텍스트 입력 값 목록")
+    count: int = Field(..., examples=[5, 10], description="각 텍스트별 반환받을 밈 개수")
+    include_tags: List[str] = Field([], examples=[['웃긴']], description="모든 텍스트에 공통으로 적용할, 모두 포함해야 하는 태그")
+    exclude_tags: List[str] = Field([], examples=[['슬픈']], description="모든 텍스트에 공통으로 적용할, 하나라도 있으면 제외할 태그")
+    nprobe: Optional[int] = Field(None, ge=1, examples=[8, 32], description="ivf 엔진에서 탐색할 리스트 수 (클수록 느리고 정확함)")
 
 # Full response class definition
 class FullRecReturn(BaseModel):
     count: int
-    recommendations: list[IndvMemeReturn]
\ No newline at end of file
+    recommendations: list[IndvMemeReturn]
+    degraded: bool = False
+
+class BatchRecReturn(BaseModel):
+    results: list[FullRecReturn]
+
+# Admin index reload result
+class IndexStatus(BaseModel):
+    version: str
+    vectors: int
+    reloaded: bool
+
+# One NDJSON line of the streaming endpoint; stage is "vector" (preliminary), "final",
+# or "error" (a later stage failed after the response started; error carries the message)
+class StreamRecReturn(FullRecReturn):
+    stage: str
+    error: Optional[str] = None
\ No newline at end of file
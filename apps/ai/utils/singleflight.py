@@ -0,0 +1,57 @@
+import asyncio
+from loguru import logger
+from typing import Awaitable, Callable, Dict, Hashable, List, Tuple, TypeVar
+from .profiling import record_timing, request_timings
+
+T = TypeVar("T")
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the computation,
+    everyone arriving while it is in flight awaits the same task.
+    The task is shielded, so one caller disconnecting doesn't cancel it for the others.
+    Stage timings recorded by the computation (profiling.record_timing) are copied to every caller's request.
+    """
+
+    def __init__(self):
+
+        self._inflight: Dict[Hashable, Tuple[asyncio.Task, List[Tuple[str, float]]]] = {}
+        self.started = 0
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if key in self._inflight and self._inflight[key][0] is task:
+            del self._inflight[key]
+
+    @staticmethod
+    async def _run(fn: Callable[[], Awaitable[T]], timings: List[Tuple[str, float]]) -> T:
+        # Runs in the task's own copy of the context, so the caller's timings are untouched
+        request_timings.set(timings)
+        return await fn()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+
+        entry = self._inflight.get(key)
+
+        if entry is None:
+            timings: List[Tuple[str, float]] = []
+            task = asyncio.ensure_future(self._run(fn, timings))
+            self._inflight[key] = (task, timings)
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.started += 1
+        else:
+            task, timings = entry
+            self.shared += 1
+            logger.debug(f"Joining in-flight computation for {key}.")
+
+        try:
+            return await asyncio.shield(task)
+        finally:
+            for name, seconds in list(timings):
+                record_timing(name, seconds)
@@ -0,0 +1,69 @@
+import json
+import os
+from datetime import datetime
+from loguru import logger
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Pointer file naming the live snapshot inside a snapshot directory
+POINTER = "CURRENT"
+
+def write_atomic(path: str, text: str) -> None:
+    """
+    Writes to a temp file in the same directory and renames it over `path`,
+    so readers only ever see the old or the new file, never a partial one.
+    """
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def publish_snapshot(
+    records: Iterable[Dict[str, Any]], snapshot_dir: str, keep: int = 3,
+    derive: Optional[Callable[[List[Dict[str, Any]], str], None]] = None
+) -> str:
+    """
+    Writes a new immutable vectors-<timestamp>.json snapshot, then points CURRENT at it.
+    derive(records, "<snapshot stem>.idx"), if given, writes the snapshot's index file first,
+    so servers never see a snapshot without it.
+    Older snapshots beyond the newest `keep` are removed. Returns the snapshot's path.
+    """
+    records = list(records)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    # Fixed-width timestamps, so name order is publish order
+    name = f"vectors-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.json"
+    while os.path.exists(os.path.join(snapshot_dir, name)):
+        name = f"vectors-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.json"
+
+    snapshot_path = os.path.join(snapshot_dir, name)
+    write_atomic(snapshot_path, json.dumps(records))
+    if derive is not None:
+        derive(records, os.path.splitext(snapshot_path)[0] + ".idx")
+    write_atomic(os.path.join(snapshot_dir, POINTER), name)
+    logger.success(f"Published index snapshot {snapshot_path}.")
+
+    snapshots = sorted(f for f in os.listdir(snapshot_dir) if f.startswith("vectors-") and f.endswith(".json"))
+    for old in snapshots[:-keep]:
+        if old != name:
+            # Along with the files derived from it (index file, float32 rescoring matrix)
+            stem = os.path.splitext(old)[0]
+            for f in os.listdir(snapshot_dir):
+                if f == old or f.startswith(stem + "."):
+                    os.remove(os.path.join(snapshot_dir, f))
+
+    return snapshot_path
+
+def current_snapshot(snapshot_dir: str) -> Optional[str]:
+    """
+    Path of the live snapshot, or None if the directory has none.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, POINTER), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    snapshot_path = os.path.join(snapshot_dir, name)
+    return snapshot_path if name and os.path.exists(snapshot_path) else None
@@ -0,0 +1,63 @@
+import numpy as np
+from loguru import logger
+from typing import Dict, Iterable, List, Optional
+
+class TagBitmapIndex:
+    """
+    One packed bitset per tag over the rows of a LocalVectorIndex: bit i is set when row i's image has the tag.
+    A filter is a few bitwise ops over n / 8 bytes, unpacked into a row mask that the
+    vector search applies before top-k, so filtered queries cost the same as unfiltered ones.
+    """
+
+    def __init__(self, ids: np.ndarray, tags: Dict[int, List[str]], version: Optional[str] = None, base: Optional[Dict[str, np.ndarray]] = None):
+        """
+        tags: image_id -> tags. base: tag -> rows precomputed offline (an index file's tag section);
+        the images in `tags` override their base rows.
+        """
+        self.n = ids.shape[0]
+        self.version = version
+
+        masks: Dict[str, np.ndarray] = {}
+        for tag, rows in (base or {}).items():
+            masks[tag] = np.zeros(self.n, dtype=bool)
+            masks[tag][rows] = True
+
+        if tags and self.n:
+            order = np.argsort(ids, kind="stable")
+            keys = np.fromiter(tags, dtype=np.int64, count=len(tags))
+            pos = np.minimum(np.searchsorted(ids[order], keys), self.n - 1)
+            rows = np.where(ids[order][pos] == keys, order[pos], -1)
+
+            for row, image_tags in zip(rows, tags.values()):
+                if row < 0:
+                    continue
+                if base:
+                    for mask in masks.values():
+                        mask[row] = False
+                for tag in image_tags:
+                    if tag not in masks:
+                        masks[tag] = np.zeros(self.n, dtype=bool)
+                    masks[tag][row] = True
+
+        self._bits: Dict[str, np.ndarray] = {tag: np.packbits(mask) for tag, mask in masks.items() if mask.any()}
+
+        logger.info(f"Built tag bitsets for {len(self._bits)} tags over {self.n} vectors.")
+
+    @property
+    def tags(self) -> List[str]:
+        return sorted(self._bits)
+
+    def mask(self, include: Iterable[str] = (), exclude: Iterable[str] = ()) -> np.ndarray:
+        """
+        Row mask of images carrying every included tag and none of the excluded ones.
+        An unknown included tag matches nothing; an unknown excluded tag excludes nothing.
+        """
+        empty = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+        bits = np.full_like(empty, 0xFF)
+
+        for tag in include:
+            bits &= self._bits.get(tag, empty)
+        for tag in exclude:
+            bits &= ~self._bits.get(tag, empty)
+
+        return np.unpackbits(bits, count=self.n).astype(bool)
@@ -0,0 +1,369 @@
+import hashlib
+import json
+import os
+import numpy as np
+from loguru import logger
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .schema import VectorHit
+
+PRECISIONS = ("float32", "float16", "int8")
+
+def quantize(matrix: np.ndarray, precision: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Scalar-quantizes unit rows: float16 as is, int8 with one scale per vector (max |x| / 127).
+    Returns (codes, scales); scales is None unless int8.
+    """
+    if precision == "float16":
+        return matrix.astype(np.float16), None
+    if precision == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    raise ValueError(f"Invalid precision '{precision}'. Must be one of {list(PRECISIONS)}")
+
+def coarse_codes(matrix: np.ndarray, precision: str = "float32", coarse_dim: Optional[int] = None) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    """
+    (codes, scales) the scan runs over: (None, None) for a plain exact float32 scan,
+    otherwise the quantized and/or Matryoshka-truncated rows.
+    """
+    if coarse_dim and coarse_dim < matrix.shape[1]:
+        matrix = truncate(matrix, coarse_dim)
+    elif precision == "float32":
+        return None, None
+
+    if precision == "float32":
+        return matrix, None
+
+    return quantize(matrix, precision)
+
+def truncate(matrix: np.ndarray, dim: int) -> np.ndarray:
+    """
+    Matryoshka prefix: the first `dim` components of each row, re-normalized.
+    Only meaningful for embeddings trained to be truncatable (gemini-embedding-001 is).
+    """
+    prefix = np.array(matrix[..., :dim], dtype=np.float32)
+    norms = np.linalg.norm(prefix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return prefix / norms
+
+def write_rescore_matrix(path: str, matrix: np.ndarray) -> None:
+    """
+    Offline export of the float32 rows that quantized/Matryoshka indexes rescore from (<vectors stem>.f32.npy).
+    Written to a temp file and renamed, so servers mapping the old file are never disturbed.
+    """
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    logger.success(f"Wrote float32 rescoring matrix {path} ({matrix.shape[0]} x {matrix.shape[1]}).")
+
+def open_rescore_matrix(path: str, matrix: np.ndarray, samples: int = 64) -> Optional[np.ndarray]:
+    """
+    Maps an exported rescoring matrix read-only, or returns None if it is missing or does not hold
+    `matrix`'s rows (checked on its shape and a few evenly spaced rows). Never writes the file.
+    """
+    try:
+        mapped = np.load(path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not map {path} ({e}); export it with embedder.py. Keeping the float32 rows in memory.")
+        return None
+
+    rows = np.linspace(0, matrix.shape[0] - 1, num=min(samples, matrix.shape[0]), dtype=np.int64)
+    if mapped.dtype != np.float32 or mapped.shape != matrix.shape or not np.allclose(mapped[rows], matrix[rows], atol=1e-5):
+        logger.warning(f"{path} does not match the loaded vectors; re-export it. Keeping the float32 rows in memory.")
+        return None
+
+    return mapped
+
+def _topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the indices of the k largest scores, best first.
+    argpartition is O(n), so only the k survivors get sorted.
+    """
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
+
+class LocalVectorIndex:
+    """
+    In-process exact cosine search over the meme embeddings.
+
+    All vectors live in one contiguous float32 matrix (n x dim) with unit rows,
+    so a query is a single matmul followed by an argpartition top-k.
+
+    With precision float16 or int8, the scan runs over quantized codes (2x / 4x smaller) instead,
+    and only a short list of rescore_mult * k rows is rescored exactly in float32.
+    The float32 rows are then mapped from rescore_path, the export next to the index (write_rescore_matrix),
+    so only the rescored rows are ever paged in; without a matching export they stay in memory.
+    With coarse_dim (e.g. 256 of 768), the scan runs over re-normalized Matryoshka prefixes
+    (optionally quantized as well), and the short list is rescored with the full vectors.
+
+    Id lookups go through a sorted id array (searchsorted), not a dict, so an index mapped
+    from an index file (see utils/indexfile.py) costs each worker no per-vector Python objects.
+    """
+
+    # Rows upcast per block during a quantized scan; the block stays in cache, the codes stream from memory
+    SCAN_BLOCK = 4096
+
+    def __init__(self, ids: Iterable[int], vectors: Any, precision: str = "float32", rescore_mult: int = 4, rescore_path: Optional[str] = None, coarse_dim: Optional[int] = None):
+
+        self.ids = np.asarray(list(ids), dtype=np.int64)
+        matrix = np.array(vectors, dtype=np.float32, order="C")
+
+        if matrix.ndim != 2 or matrix.shape[0] != self.ids.shape[0]:
+            raise ValueError(f"Vector matrix shape {matrix.shape} does not match {self.ids.shape[0]} ids.")
+
+        # Re-normalize rows; JSON round trips lose a little precision
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+
+        # Content hash, used to tag caches computed against this corpus
+        version = hashlib.blake2b(self.ids.tobytes() + matrix.tobytes(), digest_size=8).hexdigest()
+
+        codes, scales = coarse_codes(matrix, precision, coarse_dim)
+        if codes is not None:
+            # The scan reads the codes; the in-memory float32 copy is dropped for a mapping of the export, if it matches.
+            # Never spilled to a temp file: in the container the temp dir is tmpfs, i.e. memory anyway
+            mapped = open_rescore_matrix(rescore_path, matrix) if rescore_path else None
+            if mapped is not None:
+                matrix = mapped
+
+        order = np.argsort(self.ids, kind="stable")
+        self._attach(self.ids, matrix, version, order, self.ids[order], precision, rescore_mult, codes, scales)
+
+    def _attach(self, ids, matrix, version, order, sorted_ids, precision, rescore_mult, codes, scales) -> None:
+
+        self.ids = ids
+        self.matrix = matrix
+        self.dim = matrix.shape[1]
+        self.version = version
+        self.order = order
+        self.sorted_ids = sorted_ids
+        self.precision = precision
+        self.rescore_mult = rescore_mult
+        self.codes: Optional[np.ndarray] = codes
+        self.scales: Optional[np.ndarray] = scales
+        # Components of the query the scan uses; the full dim unless codes hold Matryoshka prefixes
+        self.coarse_dim = codes.shape[1] if codes is not None else self.dim
+
+    @classmethod
+    def from_arrays(
+        cls, ids: np.ndarray, matrix: np.ndarray, version: str, order: np.ndarray, sorted_ids: np.ndarray,
+        precision: str = "float32", rescore_mult: int = 4,
+        codes: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None
+    ) -> "LocalVectorIndex":
+        """
+        Wraps already-normalized arrays (e.g. read-only views of a mapped index file) without copying them.
+        """
+        index = cls.__new__(cls)
+        index._attach(ids, matrix, version, order, sorted_ids, precision, rescore_mult, codes, scales)
+        return index
+
+    def __len__(self) -> int:
+        return self.ids.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Bytes the scan reads per query (and keeps resident).
+        """
+        if self.codes is None:
+            return self.matrix.nbytes
+
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], **kwargs) -> "LocalVectorIndex":
+        """
+        Builds the index from {"image_id", "vector"} records, i.e. the IndvVector shape embedder.py produces.
+        """
+        ids: List[int] = []
+        vectors: List[List[float]] = []
+
+        for record in records:
+            if record.get("vector") is None or record.get("image_id") is None:
+                continue
+            ids.append(int(record["image_id"]))
+            vectors.append(list(record["vector"]))
+
+        if not vectors:
+            raise ValueError("No vectors to build the index from.")
+
+        return cls(ids=ids, vectors=np.array(vectors, dtype=np.float32), **kwargs)
+
+    @classmethod
+    def from_json(cls, path: str, **kwargs) -> "LocalVectorIndex":
+        """
+        Loads a JSON export of [{"image_id": ..., "vector": [...]}, ...].
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+
+        index = cls.from_records(records, **kwargs)
+        logger.info(f"Loaded {len(index)} vectors ({index.dim} dims, {index.precision}) from {path}.")
+        return index
+
+    @classmethod
+    def from_firestore(cls, collection, **kwargs) -> "LocalVectorIndex":
+        """
+        Pulls every vector document from the Firestore collection embedder.py uploads to.
+        """
+        records = []
+        for doc in collection.stream():
+            data = doc.to_dict()
+            records.append({"image_id": data.get("image_id"), "vector": data.get("vector")})
+
+        index = cls.from_records(records, **kwargs)
+        logger.info(f"Loaded {len(index)} vectors ({index.dim} dims, {index.precision}) from Firestore.")
+        return index
+
+    def rows_of(self, image_ids: Iterable[int]) -> np.ndarray:
+        """
+        Matrix rows of the given ids, -1 for ids not in the index.
+        """
+        q = np.asarray(list(image_ids), dtype=np.int64)
+        if not len(self) or not q.shape[0]:
+            return np.full(q.shape[0], -1, dtype=np.int64)
+
+        pos = np.minimum(np.searchsorted(self.sorted_ids, q), len(self) - 1)
+        return np.where(self.sorted_ids[pos] == q, self.order[pos], -1)
+
+    def get_vectors(self, image_ids: List[int]) -> np.ndarray:
+        """
+        Stored (unit) vectors for the given ids, in order; unknown ids get a zero row.
+        """
+        rows = self.rows_of(image_ids)
+        out = np.zeros((len(image_ids), self.dim), dtype=np.float32)
+        found = rows >= 0
+        out[found] = self.matrix[rows[found]]
+
+        return out
+
+    def _coarse(self, Q: np.ndarray) -> np.ndarray:
+        return Q if self.coarse_dim == self.dim else truncate(Q, self.coarse_dim)
+
+    def _scan(self, Q: np.ndarray) -> np.ndarray:
+        """
+        (m x n) scores of the queries against every row: exact for float32, approximate otherwise.
+        """
+        if self.codes is None:
+            return Q @ self.matrix.T
+
+        Q = self._coarse(Q)
+        if self.codes.dtype == np.float32:
+            return Q @ self.codes.T
+
+        scores = np.empty((Q.shape[0], self.codes.shape[0]), dtype=np.float32)
+        for start in range(0, self.codes.shape[0], self.SCAN_BLOCK):
+            stop = start + self.SCAN_BLOCK
+            scores[:, start:stop] = Q @ self.codes[start:stop].astype(np.float32).T
+        if self.scales is not None:
+            scores *= self.scales
+
+        return scores
+
+    def _select(self, q: np.ndarray, scores: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[VectorHit]:
+        """
+        Top k of one query's scan scores; quantized scans get their short list rescored in float32.
+        scores[j] belongs to matrix row rows[j] (or row j if rows is None).
+        """
+        if self.codes is None:
+            picked = _topk(scores, k)
+            exact = scores[picked]
+        else:
+            # Ascending positions, so a memory-mapped matrix is read front to back
+            short = _topk(scores, k * self.rescore_mult)
+            short = np.sort(short[np.isfinite(scores[short])])
+            rescored = self.matrix[short if rows is None else rows[short]] @ q
+            top = _topk(rescored, k)
+            picked, exact = short[top], rescored[top]
+
+        picked = picked if rows is None else rows[picked]
+        return [VectorHit(image_id=int(self.ids[row]), score=float(score)) for row, score in zip(picked, exact)]
+
+    def search_rows(self, query: Any, rows: np.ndarray, k: int = 5) -> List[VectorHit]:
+        """
+        Cosine top-k among the given rows only (e.g. an ANN index's probed lists).
+        """
+        q = np.asarray(query, dtype=np.float32)
+        rows = np.sort(rows)
+        if self.codes is None:
+            scores = self.matrix[rows] @ q
+        else:
+            scores = self.codes[rows].astype(np.float32) @ self._coarse(q)
+            if self.scales is not None:
+                scores *= self.scales[rows]
+
+        return self._select(q, scores, min(k, rows.shape[0]), rows)
+
+    def search(self, query: Any, k: int = 5, mask: Optional[np.ndarray] = None) -> List[VectorHit]:
+        """
+        Cosine top-k for a single (normalized) query vector.
+        With a row mask (see TagBitmapIndex), only masked-in rows compete for the top k.
+        """
+        q = np.asarray(query, dtype=np.float32)
+        scores = self._scan(q[None, :])[0]
+        if mask is not None:
+            scores[~mask] = -np.inf
+            k = min(k, int(np.count_nonzero(mask)))
+
+        return self._select(q, scores, k)
+
+    def search_batch(self, queries: Any, k: int = 5, mask: Optional[np.ndarray] = None) -> List[List[VectorHit]]:
+        """
+        Cosine top-k for several query vectors with one (m x dim) @ (dim x n) scan.
+        A row mask applies to every query.
+        """
+        Q = np.asarray(queries, dtype=np.float32)
+        scores = self._scan(Q)
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+            k = min(k, int(np.count_nonzero(mask)))
+
+        return [self._select(q, row, k) for q, row in zip(Q, scores)]
+
+# Recall@k of the quantized and Matryoshka variants against exact search: python -m utils.vindex [vectors.json] [k]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "index/vectors.json"
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    with open(path, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    exact = LocalVectorIndex.from_records(records)
+
+    # Queries: perturbed copies of stored vectors, so each has a meaningful neighbourhood
+    rng = np.random.default_rng(0)
+    sample = exact.matrix[rng.choice(len(exact), size=min(200, len(exact)), replace=False)]
+    queries = sample + rng.normal(scale=0.5 / np.sqrt(exact.dim), size=sample.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = [{hit.image_id for hit in hits} for hits in exact.search_batch(queries, k)]
+
+    variants = [(precision, None) for precision in PRECISIONS]
+    variants += [(precision, coarse_dim) for coarse_dim in (256, 128) if coarse_dim < exact.dim for precision in ("float32", "int8")]
+
+    for precision, coarse_dim in variants:
+        if precision == "float32" and coarse_dim is None:
+            index = exact
+        else:
+            index = LocalVectorIndex.from_records(records, precision=precision, coarse_dim=coarse_dim)
+
+        started = time.perf_counter()
+        results = [index.search(q, k) for q in queries]
+        elapsed = (time.perf_counter() - started) / len(queries)
+
+        recall = np.mean([len({hit.image_id for hit in hits} & expected) / len(expected) for hits, expected in zip(results, truth)])
+        label = precision + (f"/{coarse_dim}d" if coarse_dim else "")
+        print(f"{label:>12}: {index.nbytes / 2**20:8.2f} MiB scanned, recall@{k} {recall:.4f}, {elapsed * 1e3:.2f} ms/query")
@@ -0,0 +1,2 @@
+-- AlterTable
+ALTER TABLE `Image` ADD COLUMN `rerank_caption` TEXT NULL;